@@ -1,39 +1,203 @@
 #!/usr/bin/env python3
 
 import base64
+import bisect
 import cmd
 from collections import defaultdict
-from functools import partial
+from collections.abc import MutableMapping
+from contextlib import contextmanager, ExitStack
+import difflib
+from functools import partial, wraps
 import hashlib
 from http import HTTPStatus
-import http.server
 import json
 import math
+import mmap
 import os
 import re
 import shlex
-import socketserver
+import stat
+import queue
+import random
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+import urllib.error
 import urllib.parse
-import urllib.request
 import shutil
-import xml.etree.ElementTree
 import zlib
 
 def hash_line(s):
     return base64.b64encode(hashlib.sha256(s.encode('utf-8')).digest(), b'-_')[:12].decode('utf-8')
 
+def digest(s):
+    # fingerprint of an (already normalized) entry, used for comparisons
+    return hashlib.blake2b(s.encode('utf-8'), digest_size=16).digest()
+
+class Metrics:
+    '''Counters and histograms exposed by the web server at /metrics
+    in the Prometheus text format.'''
+    time_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300]
+    size_buckets = [1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26,
+                    1 << 28, 1 << 30, 1 << 32, 1 << 34]
+    kinds = {
+        'regtest_requests_total': ('counter', 'Callback requests by action'),
+        'regtest_request_seconds': ('histogram', 'Time to handle a callback, including waiting for the lock'),
+        'regtest_lock_wait_seconds': ('histogram', 'Time spent waiting for the callback lock'),
+        'regtest_json_serialize_seconds': ('histogram', 'Time spent encoding JSON responses'),
+        'regtest_json_compress_seconds': ('histogram', 'Time spent compressing JSON responses'),
+        'regtest_response_bytes': ('histogram', 'Size of JSON responses before compression'),
+        'regtest_corpus_load_seconds': ('histogram', 'Time spent in Corpus.load()'),
+        'regtest_step_seconds': ('histogram', 'Duration of pipeline steps'),
+        'regtest_cache_hits_total': ('counter', 'Cache lookups that found an entry'),
+        'regtest_cache_misses_total': ('counter', 'Cache lookups that found nothing'),
+        'regtest_step_peak_rss_bytes': ('histogram', 'Peak resident memory of pipeline steps')
+    }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # { (name, labels) : value }
+        self.histograms = {} # { (name, labels) : [bucket counts, sum, count] }
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+    def observe(self, name, value, buckets=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = buckets or Metrics.time_buckets
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            h = self.histograms[key]
+            for i, b in enumerate(buckets):
+                if value <= b:
+                    h[1][i] += 1
+            h[2] += value
+            h[3] += 1
+    def render(self):
+        def fmt(labels, extra=()):
+            ls = list(labels) + list(extra)
+            if not ls:
+                return ''
+            return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in ls) + '}'
+        lines = []
+        seen = set()
+        with self.lock:
+            for (name, labels), val in sorted(self.counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append('# HELP %s %s' % (name, Metrics.kinds[name][1]))
+                    lines.append('# TYPE %s counter' % name)
+                lines.append('%s%s %s' % (name, fmt(labels), val))
+            for (name, labels), (buckets, counts, total, n) in sorted(self.histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append('# HELP %s %s' % (name, Metrics.kinds[name][1]))
+                    lines.append('# TYPE %s histogram' % name)
+                for b, c in zip(buckets, counts):
+                    lines.append('%s_bucket%s %s' % (name, fmt(labels, [('le', b)]), c))
+                lines.append('%s_bucket%s %s' % (name, fmt(labels, [('le', '+Inf')]), n))
+                lines.append('%s_sum%s %s' % (name, fmt(labels), total))
+                lines.append('%s_count%s %s' % (name, fmt(labels), n))
+        return '\n'.join(lines) + '\n'
+
+THE_METRICS = Metrics()
+
+class Profiler:
+    '''Enabled by --profile: runs cProfile and tracemalloc and attributes
+    time and allocations to the named phases marked with @phase().
+    Time and allocations of nested phases are only counted once, in the
+    innermost phase.'''
+    def __init__(self, fname):
+        import cProfile
+        self.fname = fname
+        self.profile = cProfile.Profile()
+        self.stats = defaultdict(lambda: [0, 0.0, 0]) # { phase : [calls, seconds, bytes] }
+        self.local = threading.local()
+        self.start_time = None
+        self.finished = False
+    def start(self):
+        import tracemalloc
+        tracemalloc.start()
+        self.start_time = time.time()
+        self.profile.enable()
+    def enable_thread(self):
+        # cProfile only follows the thread which enabled it
+        try:
+            self.profile.enable()
+        except ValueError:
+            pass
+    def disable_thread(self):
+        self.profile.disable()
+    @contextmanager
+    def phase(self, name):
+        import tracemalloc
+        stack = self.local.__dict__.setdefault('stack', [])
+        frame = [0.0, 0] # time and memory of nested phases
+        stack.append(frame)
+        t0 = time.time()
+        m0 = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            dt = time.time() - t0
+            dm = tracemalloc.get_traced_memory()[0] - m0
+            stack.pop()
+            st = self.stats[name]
+            st[0] += 1
+            st[1] += dt - frame[0]
+            st[2] += dm - frame[1]
+            if stack:
+                stack[-1][0] += dt
+                stack[-1][1] += dm
+    def finish(self):
+        import tracemalloc
+        if self.finished:
+            return
+        self.finished = True
+        self.profile.disable()
+        total = time.time() - self.start_time
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.profile.dump_stats(self.fname)
+        print('')
+        print('%-16s %10s %12s %7s %14s' % ('phase', 'calls', 'seconds', '%', 'net alloc (MB)'))
+        accounted = 0.0
+        for name, (calls, secs, mem) in sorted(self.stats.items(), key=lambda x: -x[1][1]):
+            accounted += secs
+            print('%-16s %10s %12.3f %7.1f %14.2f' % (name, calls, secs, 100.0*secs/total if total else 0, mem / (1 << 20)))
+        print('%-16s %10s %12.3f %7.1f' % ('(other)', '', total - accounted, 100.0*(total-accounted)/total if total else 0))
+        print('Total %.3f seconds, peak traced memory %.2f MB' % (total, peak / (1 << 20)))
+        print('Profile written to %s (read it with `python3 -m pstats %s`)' % (self.fname, self.fname))
+
+THE_PROFILER = None
+
+def phase(name):
+    # attribute time spent in the decorated function to a profiling phase
+    def wrap(fn):
+        @wraps(fn)
+        def profiled(*args, **kwargs):
+            if THE_PROFILER is None:
+                return fn(*args, **kwargs)
+            with THE_PROFILER.phase(name):
+                return fn(*args, **kwargs)
+        return profiled
+    return wrap
+
 class InputFileDoesNotExist(FileNotFoundError):
     pass
 class InputFileIsEmpty(Exception):
     pass
 class ErrorInPipeline(Exception):
     pass
+class ResourceLimitExceeded(ErrorInPipeline):
+    pass
+class ThresholdUnreachable(Exception):
+    pass
 
 def ensure_javascript(spath):
+    import urllib.request
     if not os.path.exists(spath + '/bootstrap.css') or not os.path.exists(spath + '/bootstrap.js') or not os.path.exists(spath + '/jquery.js') or not os.path.exists(spath + '/diff.js'):
         print('Downloading Bootstrap, jQuery, and jsDiff from the jsDelivr CDN')
         with urllib.request.urlopen('https://cdn.jsdelivr.net/npm/bootstrap@5.1/dist/css/bootstrap.min.css') as response, open(spath + '/bootstrap.css', 'wb') as out_file:
@@ -45,44 +209,379 @@ def ensure_javascript(spath):
         with urllib.request.urlopen('https://cdn.jsdelivr.net/npm/diff@4.0/dist/diff.min.js') as response, open(spath + '/diff.js', 'wb') as out_file:
             shutil.copyfileobj(response, out_file)
 
+def parse_input(text, known=None):
+    # returns { hash : [line, content] } and the hashes of the
+    # non-empty lines, of which the first len(known) were computed before
+    if known is None:
+        known = []
+    ret = {}
+    hashes = []
+    for i, l_ in enumerate(text.splitlines()):
+        ls = l_.split('#')
+        l = ls.pop(0)
+        while l.endswith('\\') and ls:
+            l = l[:-1] + ls.pop(0)
+        l = l.replace('\\n', '\n').strip()
+        if not l:
+            continue
+        hsh = known[len(hashes)] if len(hashes) < len(known) else hash_line(l)
+        hashes.append(hsh)
+        ret[hsh] = [i, l]
+    return ret, hashes
+
+INPUT_INDEX = {} # { path : (size, mtime, inputs) }
+
+def index_input(fname, mtime):
+    # parse an input file using the hashes kept in test/.regtest as
+    # { size, mtime, digest, hashes }
+    # if size and mtime don't match, the hashes are still used when the
+    # digest does, and if lines were only appended, just those are hashed
+    name = 'input-%s.json' % hash_line(os.path.normpath(fname))
+    idx = load_state(name, None)
+    with open(fname, 'rb') as fin:
+        raw = fin.read()
+    if idx and idx['size'] == len(raw) and idx['mtime'] == mtime:
+        return parse_input(raw.decode('utf-8'), idx['hashes'])[0]
+    old = idx['size'] if idx else 0
+    h = hashlib.sha256(raw[:old])
+    known = []
+    if (idx and old <= len(raw) and h.hexdigest() == idx['digest']
+        and (old == len(raw) or raw[:old].endswith(b'\n'))):
+        known = idx['hashes']
+    else:
+        h = hashlib.sha256()
+        old = 0
+    h.update(raw[old:])
+    ret, hashes = parse_input(raw.decode('utf-8'), known)
+    if ret:
+        # a file changed within the timestamp resolution of its last write
+        # could be changed again without changing mtime, so check the
+        # digest next time
+        if time.time_ns() - mtime < 2 * 10**9:
+            mtime = None
+        save_state(name, {'size': len(raw), 'mtime': mtime,
+                          'digest': h.hexdigest(), 'hashes': hashes})
+    return ret
+
+@phase('hashing')
 def load_input(fname):
     try:
-        with open(fname, 'r') as fin:
-            lines = fin.read().splitlines()
-            ret = {}
-            for i, l_ in enumerate(lines):
-                ls = l_.split('#')
-                l = ls.pop(0)
-                while l.endswith('\\') and ls:
-                    l = l[:-1] + ls.pop(0)
-                l = l.replace('\\n', '\n').strip()
-                if not l:
-                    continue
-                ret[hash_line(l)] = [i, l]
-            if len(ret) == 0:
-                print('ERROR: Input file %s was empty!' % fname)
-                raise InputFileIsEmpty(fname)
-            return ret
+        st = os.stat(fname)
+        known = INPUT_INDEX.get(fname)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            THE_METRICS.inc('regtest_cache_hits_total', cache='input')
+            return known[2]
+        THE_METRICS.inc('regtest_cache_misses_total', cache='input')
+        ret = index_input(fname, st.st_mtime_ns)
+        if len(ret) == 0:
+            print('ERROR: Input file %s was empty!' % fname)
+            raise InputFileIsEmpty(fname)
+        # shared by every corpus and step reading this file, so callers
+        # must not modify it
+        INPUT_INDEX[fname] = (st.st_size, st.st_mtime_ns, ret)
+        return ret
     except FileNotFoundError:
         print('ERROR: Input file %s does not exist!' % fname)
         raise InputFileDoesNotExist(fname)
 
-def load_input_string(fname):
+@phase('hashing')
+def load_input_string(fname, hashes=None):
+    # if hashes is given, only those lines are included
+    return format_input(load_input(fname), hashes)
+
+def format_input(ins, hashes=None):
+    if hashes is not None:
+        ins = {h: ins[h] for h in hashes if h in ins}
     txt = ''
-    for hsh, (line, content) in load_input(fname).items():
+    for hsh, (line, content) in ins.items():
         txt += '[%s#%s] %s\n[/%s]\n\0' % (hsh, line, content, hsh)
     return txt
 
 # [hash(#line)?] content [/hash]
 hash_format = re.compile(r'\[([A-Za-z0-9_-]+)(#\d+|)\](.*?)\[/\1\]', re.DOTALL)
+hash_format_bytes = re.compile(hash_format.pattern.encode('utf-8'), re.DOTALL)
+hash_close_bytes = re.compile(rb'\[/[A-Za-z0-9_-]+\]')
 # the line number is completely useless, but it now appears
 # in the expected files in 365 repositories, so we need to still
 # parse it - 2021-07-23
 
-def load_output(fname, should_sort_analyses=False):
+# output files at least this large are indexed rather than read
+MMAP_THRESHOLD = 16 << 20
+
+class OutputDict(dict):
+    def digest(self, hsh):
+        return self[hsh][2]
+
+class LazyOutput(MutableMapping):
+    '''Entries of an output or expected file which are only decoded
+    when they are looked up. Subclasses fill in self.index as
+    hash => line and implement raw(hash).'''
+    def __init__(self, should_sort_analyses=False, normalize=None):
+        self.should_sort_analyses = should_sort_analyses
+        self.normalize = normalize
+        self.index = {}
+        self.digests = {}
+        self.replaced = {} # entries changed since loading
+    @phase('parsing')
+    def text(self, hsh):
+        content = self.raw(hsh)
+        if self.should_sort_analyses:
+            content = sort_analyses(content)
+        return content
+    def digest(self, hsh):
+        if hsh in self.replaced:
+            return self.replaced[hsh][2]
+        if hsh not in self.digests:
+            content = self.text(hsh)
+            self.digests[hsh] = digest(self.normalize(content) if self.normalize else content)
+        return self.digests[hsh]
+    def __getitem__(self, hsh):
+        if hsh in self.replaced:
+            return self.replaced[hsh]
+        return [self.index[hsh], self.text(hsh), self.digest(hsh)]
+    def stored(self, hsh):
+        # the bytes of the entry in the file, if there is a file and
+        # the entry wasn't replaced, otherwise None
+        return None
+    def __setitem__(self, hsh, entry):
+        self.replaced[hsh] = entry
+    def __delitem__(self, hsh):
+        if hsh not in self:
+            raise KeyError(hsh)
+        self.replaced.pop(hsh, None)
+        self.index.pop(hsh, None)
+        self.digests.pop(hsh, None)
+    def __contains__(self, hsh):
+        return hsh in self.replaced or hsh in self.index
+    def __iter__(self):
+        yield from self.index
+        for hsh in self.replaced:
+            if hsh not in self.index:
+                yield hsh
+    def __len__(self):
+        return len(self.index) + sum(1 for h in self.replaced if h not in self.index)
+
+class MappedOutput(LazyOutput):
+    '''A large output or expected file. The file is mapped into memory
+    and only the positions of the entries are found up front.'''
+    def __init__(self, fname, should_sort_analyses=False, normalize=None):
+        super().__init__(should_sort_analyses, normalize)
+        self.fname = fname
+        with open(fname, 'rb') as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.spans = {}
+        for m in hash_format_bytes.finditer(self.mm):
+            start, end = m.span(3)
+            if end - start < 64 and not m.group(3).strip(b' \t\n\0'):
+                print('ERROR: Entry %s in %s was empty!' % (m.group(1).decode('utf-8'), fname))
+            hsh = m.group(1).decode('utf-8')
+            line = m.group(2)
+            self.index[hsh] = int(line[1:]) if line else 0
+            self.spans[hsh] = (start, end)
+    def raw(self, hsh):
+        start, end = self.spans[hsh]
+        return self.mm[start:end].decode('utf-8').replace('\0', '').strip()
+    def stored(self, hsh):
+        if hsh in self.replaced:
+            return None
+        start, end = self.spans[hsh]
+        return self.mm[start:end]
+
+def split_member(fname):
+    # 'test/expected/x.pack#gold/disam' => 'test/expected/x.pack', 'gold/disam'
+    pack, sep, member = fname.partition('.pack#')
+    if not sep:
+        return None, None
+    return pack + '.pack', member
+
+def output_exists(fname):
+    # os.path.isfile() for output, expected and gold files, which
+    # may be members of a Pack
+    pack, member = split_member(fname)
+    if pack:
+        return os.path.isfile(pack) and member in Pack.open(pack).members
+    return os.path.isfile(fname)
+
+def delta_encode(base, text):
+    # [a, b, middle] such that text is base with all but the first a
+    # and last b characters replaced by middle
+    if base == text:
+        return [len(base), 0, '']
+    n = min(len(base), len(text))
+    a = 0
+    while a < n and base[a] == text[a]:
+        a += 1
+    b = 0
+    while b < n - a and base[-1-b] == text[-1-b]:
+        b += 1
+    return [a, b, text[a:len(text)-b]]
+
+def delta_decode(base, delta):
+    a, b, middle = delta
+    return base[:a] + middle + base[len(base)-b:]
+
+class Pack:
+    '''The expected and gold outputs of every step of a corpus in one
+    file, used if tests.json has "storage": "packed" in its settings:
+
+        APERTIUM-REGTEST-PACK 1
+        { member : { "hashes": [...], "base": member, "blocks": [[offset, length], ...] } }
+        zlib-compressed blocks
+
+    Members are named like expected/disam and gold/disam. Each lists its
+    hashes in sorted order (or null if they are those of the previous
+    member) and stores the values in the same order, Pack.block to a
+    compressed JSON list, so that one entry can be read by bisecting the
+    hashes and decompressing one block. Expected members with a base are
+    delta-encoded against it: [a, b, middle] is the value of the base
+    with everything but the first a and last b characters replaced.'''
+    magic = b'APERTIUM-REGTEST-PACK 1\n'
+    block = 256
+    delta = False # delta-encode expected outputs when writing
+    cache = {} # { path : ((inode, size, mtime), Pack) }
+    cached_blocks = 256 # decompressed blocks kept per Pack
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fin:
+            if fin.readline() != Pack.magic:
+                print('ERROR: %s is not a packed file!' % path)
+                sys.exit(1)
+            self.members = json.loads(fin.readline())
+            self.start = fin.tell()
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.hashes = {}
+        prev = []
+        for name, ent in self.members.items():
+            prev = ent['hashes'] if ent['hashes'] is not None else prev
+            self.hashes[name] = prev
+        # { (member, block number) : values }, least recently used first
+        self.blocks = {}
+    @staticmethod
+    def open(path):
+        # packs are only ever replaced, so an open Pack stays valid, and
+        # replace_file() gives every new one a new inode even if size
+        # and mtime are the same
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        known = Pack.cache.get(path)
+        if known and known[0] == key:
+            return known[1]
+        pack = Pack(path)
+        Pack.cache[path] = (key, pack)
+        return pack
+    @phase('parsing')
+    def read_block(self, name, n):
+        key = (name, n)
+        if key in self.blocks:
+            self.blocks[key] = self.blocks.pop(key)
+            return self.blocks[key]
+        offset, length = self.members[name]['blocks'][n]
+        start = self.start + offset
+        if len(self.blocks) >= Pack.cached_blocks:
+            del self.blocks[next(iter(self.blocks))]
+        self.blocks[key] = json.loads(
+            zlib.decompress(self.mm[start:start+length]))
+        return self.blocks[key]
+    def value(self, name, hsh):
+        hs = self.hashes[name]
+        i = bisect.bisect_left(hs, hsh)
+        if i == len(hs) or hs[i] != hsh:
+            raise KeyError(hsh)
+        val = self.read_block(name, i // Pack.block)[i % Pack.block]
+        base = self.members[name]['base']
+        if base and isinstance(val, list):
+            return delta_decode(self.value(base, hsh), val)
+        return val
+    def read(self, name):
+        # { hash : value } of a whole member
+        return {hsh: self.value(name, hsh) for hsh in self.hashes[name]}
+    @staticmethod
+    @phase('persistence')
+    def write(path, members):
+        # members is [(name, { hash : value })], in order
+        header = {}
+        blocks = []
+        offset = 0
+        prev = None
+        base = None
+        for name, vals in members:
+            hs = sorted(vals)
+            ent = {'hashes': hs if hs != prev else None, 'base': None, 'blocks': []}
+            prev = hs
+            items = [vals[h] for h in hs]
+            if name.startswith('expected/'):
+                if Pack.delta and base:
+                    ent['base'] = base[0]
+                    for i, h in enumerate(hs):
+                        if h in base[1]:
+                            d = delta_encode(base[1][h], items[i])
+                            if d[0] + d[1] > 0:
+                                items[i] = d
+                base = (name, vals)
+            for i in range(0, len(items), Pack.block):
+                data = zlib.compress(json.dumps(items[i:i+Pack.block]).encode('utf-8'))
+                ent['blocks'].append([offset, len(data)])
+                blocks.append(data)
+                offset += len(data)
+            header[name] = ent
+        with replace_file(path, 'wb') as fout:
+            fout.write(Pack.magic)
+            fout.write(json.dumps(header).encode('utf-8') + b'\n')
+            for data in blocks:
+                fout.write(data)
+
+class PackedOutput(LazyOutput):
+    '''An expected output stored in a Pack.'''
+    def __init__(self, pack, name, should_sort_analyses=False, normalize=None):
+        super().__init__(should_sort_analyses, normalize)
+        self.pack = pack
+        self.name = name
+        self.index = dict.fromkeys(pack.hashes[name], 0)
+    def raw(self, hsh):
+        return self.pack.value(self.name, hsh)
+
+def save_packed(files):
+    # { member path : expected or gold data }, rewriting each pack once
+    packs = defaultdict(dict)
+    for fname, data in files.items():
+        pack, member = split_member(fname)
+        if member.startswith('gold/'):
+            packs[pack][member] = {h: sorted(set(opts)) for h, opts in data.items()}
+        else:
+            packs[pack][member] = {h: data[h][1] for h in data}
+    for path, changed in packs.items():
+        members = []
+        if os.path.isfile(path):
+            old = Pack.open(path)
+            for name in old.members:
+                members.append((name, changed.pop(name) if name in changed
+                                else old.read(name)))
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        members += list(changed.items())
+        Pack.write(path, members)
+
+def save_outputs(files):
+    # save_output() for { file name : data }, writing each pack once
+    packed = {f: d for f, d in files.items() if split_member(f)[0]}
+    save_packed(packed)
+    for fname, data in files.items():
+        if fname not in packed:
+            save_output(fname, data)
+
+@phase('parsing')
+def load_output(fname, should_sort_analyses=False, normalize=None):
+    # entries are [line, content, digest of normalized content]
+    pack, member = split_member(fname)
+    if pack:
+        if not output_exists(fname):
+            return OutputDict()
+        return PackedOutput(Pack.open(pack), member, should_sort_analyses, normalize)
     try:
+        if os.path.getsize(fname) >= MMAP_THRESHOLD:
+            return MappedOutput(fname, should_sort_analyses, normalize)
         with open(fname, 'r') as fin:
-            ret = {}
+            ret = OutputDict()
             txt = fin.read().replace('\0', '')
             for hsh, line, content_ in hash_format.findall(txt):
                 content = content_.strip()
@@ -93,19 +592,105 @@ def load_output(fname, should_sort_analyses=False):
                 l = 0
                 if line:
                     l = int(line[1:])
-                ret[hsh] = [l, content]
+                ret[hsh] = [l, content,
+                            digest(normalize(content) if normalize else content)]
                 # line numbers are nice for debugging,
                 # but nothing breaks if we don't have them
             return ret
     except FileNotFoundError:
-        return {}
+        return OutputDict()
+
+def output_keys(fname):
+    # the hashes of an output or expected file, without decoding or
+    # digesting any of its entries, kept in test/.regtest as
+    # { size, mtime, hashes } so that they are only found once
+    pack, member = split_member(fname)
+    if pack:
+        if not output_exists(fname):
+            return []
+        return Pack.open(pack).hashes[member]
+    try:
+        with open(fname, 'rb') as fin:
+            st = os.fstat(fin.fileno())
+            name = 'keys-%s.json' % hash_line(os.path.normpath(fname))
+            idx = load_state(name, None)
+            if idx and idx['size'] == st.st_size and idx['mtime'] == st.st_mtime_ns:
+                return idx['hashes']
+            if st.st_size == 0:
+                return []
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hashes = [m.group(1).decode('utf-8')
+                          for m in hash_format_bytes.finditer(mm)]
+    except FileNotFoundError:
+        return []
+    # as in index_input(), a file written this recently could change
+    # again without changing mtime
+    if time.time_ns() - st.st_mtime_ns >= 2 * 10**9:
+        save_state(name, {'size': st.st_size, 'mtime': st.st_mtime_ns,
+                          'hashes': hashes})
+    return hashes
+
+def same_entry(out, exp, hsh):
+    # both sides of a comparison are normalized the same way (see
+    # Corpus.normalizer_names()), so entries stored identically are equal
+    # without being decoded and digested
+    if isinstance(out, LazyOutput) and isinstance(exp, LazyOutput):
+        a = out.stored(hsh)
+        if a is not None and a == exp.stored(hsh):
+            return True
+    return out.digest(hsh) == exp.digest(hsh)
+
+def share_entries(datas):
+    # most outputs equal their expected output, and many steps change
+    # nothing, so let equal entries share one [line, content, digest]
+    # list instead of keeping a copy per file (nothing uses the line
+    # numbers of outputs, and entries are never modified in place)
+    table = {} # { digest : entry }
+    for data in datas:
+        if not isinstance(data, OutputDict):
+            continue # LazyOutput only decodes entries on demand
+        for hsh, ent in data.items():
+            known = table.get(ent[2])
+            if known is None:
+                table[ent[2]] = ent
+            elif known is not ent and known[1] == ent[1]:
+                data[hsh] = known
+
+def temp_name(fname):
+    # a name next to fname for a file which will replace it, unique to
+    # this thread, since the servers write files from several threads
+    return '%s.tmp-%s-%s' % (fname, os.getpid(), threading.get_ident())
 
+@contextmanager
+def replace_file(fname, mode='w'):
+    # write to a temporary file which replaces fname when closed,
+    # since fname may still be mapped by a MappedOutput
+    tmp = temp_name(fname)
+    try:
+        with open(tmp, mode) as fout:
+            yield fout
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+@phase('persistence')
 def save_output(fname, data):
-    with open(fname, 'w') as fout:
+    if split_member(fname)[0]:
+        save_packed({fname: data})
+        return
+    with replace_file(fname) as fout:
         for inhash in sorted(data.keys()):
             fout.write('[%s#0] %s\n[/%s]\n' % (inhash, data[inhash][1], inhash))
 
+@phase('parsing')
 def load_gold(fname):
+    pack, member = split_member(fname)
+    if pack:
+        if not output_exists(fname):
+            return {}
+        return Pack.open(pack).read(member)
     try:
         with open(fname, 'r') as fin:
             ret = {}
@@ -123,8 +708,16 @@ def load_gold(fname):
     except FileNotFoundError:
         return {}
 
+def gold_digests(data, normalize=None):
+    return {hsh: {digest(normalize(o) if normalize else o) for o in opts}
+            for hsh, opts in data.items()}
+
+@phase('persistence')
 def save_gold(fname, data):
-    with open(fname, 'w') as fout:
+    if split_member(fname)[0]:
+        save_packed({fname: data})
+        return
+    with replace_file(fname) as fout:
         for inhash in sorted(data.keys()):
             fout.write('[%s]\n' % inhash)
             for ln in sorted(set(data[inhash])):
@@ -152,6 +745,7 @@ apertium_blank_pat = ('(?:' +
                       '?')
 apertium_blank_regex = re.compile(apertium_blank_pat)
 
+@phase('normalization')
 def sort_analyses(instr):
     ret = ''
     s = instr
@@ -188,40 +782,343 @@ def sort_analyses(instr):
     ret += s # if something goes wrong, return the rest of the string as-is
     return ret
 
-def run_command(cmd, intxt, outfile, shell=False):
+@phase('normalization')
+def fold_whitespace(s):
+    return ' '.join(s.split())
+
+normalizations = {
+    'sort': sort_analyses,
+    'whitespace': fold_whitespace
+}
+
+def make_normalizer(names):
+    funcs = [normalizations[n] for n in names]
+    if not funcs:
+        return None
+    def normalize(s):
+        for f in funcs:
+            s = f(s)
+        return s
+    return normalize
+
+def find_unescaped(s, c, start=0):
+    esc = False
+    for i in range(start, len(s)):
+        if esc:
+            esc = False
+        elif s[i] == '\\':
+            esc = True
+        elif s[i] == c:
+            return i
+    return -1
+
+def tokenize_stream(instr):
+    # split a stream into lexical units and the blanks between them
+    ret = []
+    cur = ''
+    s = instr
+    while s:
+        m = apertium_blank_regex.match(s)
+        cur += s[:m.end()]
+        s = s[m.end():]
+        if not s:
+            break
+        if s[0] == '^':
+            end = find_unescaped(s, '$')
+            if end == -1:
+                cur += s
+                break
+            if cur:
+                ret.append(cur)
+                cur = ''
+            ret.append(s[:end+1])
+            s = s[end+1:]
+        else:
+            # stray ] or escaped character outside of a lexical unit
+            n = 2 if s[0] == '\\' else 1
+            cur += s[:n]
+            s = s[n:]
+    if cur:
+        ret.append(cur)
+    return ret
+
+def tokenize_lu(lu):
+    # ^a/b/c$ => ['^a', '/b', '/c$']
+    ret = []
+    last = 0
+    i = find_unescaped(lu, '/')
+    while i != -1:
+        ret.append(lu[last:i])
+        last = i
+        i = find_unescaped(lu, '/', i+1)
+    ret.append(lu[last:])
+    return ret
+
+def diff_sequences(a, b, lu_level=False):
+    ret = []
+    sm = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for op, i1, i2, j1, j2 in sm.get_opcodes():
+        if op == 'equal':
+            ret.append(['=', ''.join(a[i1:i2])])
+        elif (op == 'replace' and lu_level and i2 - i1 == j2 - j1 and
+              all(x[0] == '^' and y[0] == '^'
+                  for x, y in zip(a[i1:i2], b[j1:j2]))):
+            for x, y in zip(a[i1:i2], b[j1:j2]):
+                ret.append(['~', diff_sequences(tokenize_lu(x),
+                                                tokenize_lu(y))])
+        else:
+            if i2 > i1:
+                ret.append(['-', ''.join(a[i1:i2])])
+            if j2 > j1:
+                ret.append(['+', ''.join(b[j1:j2])])
+    return ret
+
+THE_DIFF_CACHE = {}
+DIFF_CACHE_SIZE = 10000
+
+def diff_outputs(expect, output, key):
+    '''Diff two entries, returning a list of [op, text] pairs where op
+    is '=', '-', or '+', or ['~', [...]] for a lexical unit whose
+    readings changed. Results are cached by key, the digests of both
+    entries, which are of normalized text, so the texts are checked too.'''
+    known = THE_DIFF_CACHE.get(key)
+    if known and known[0] == expect and known[1] == output:
+        THE_METRICS.inc('regtest_cache_hits_total', cache='diff')
+        return known[2]
+    THE_METRICS.inc('regtest_cache_misses_total', cache='diff')
+    a = tokenize_stream(expect)
+    b = tokenize_stream(output)
+    lu_level = True
+    if not any(t[0] == '^' for t in a + b):
+        # not stream format, so fall back to lines
+        a = expect.splitlines(keepends=True)
+        b = output.splitlines(keepends=True)
+        lu_level = False
+    ret = diff_sequences(a, b, lu_level)
+    if key not in THE_DIFF_CACHE and len(THE_DIFF_CACHE) >= DIFF_CACHE_SIZE:
+        del THE_DIFF_CACHE[next(iter(THE_DIFF_CACHE))]
+    THE_DIFF_CACHE[key] = (expect, output, ret)
+    return ret
+
+def format_diff(ops, color=False):
+    if color:
+        marks = {'-': ('\033[31m', '\033[0m'), '+': ('\033[32m', '\033[0m')}
+    else:
+        marks = {'-': ('[-', '-]'), '+': ('{+', '+}')}
+    ret = ''
+    for op, val in ops:
+        if op == '~':
+            ret += format_diff(val, color)
+        elif op == '=':
+            ret += val
+        else:
+            ret += marks[op][0] + val + marks[op][1]
+    return ret
+
+@phase('pipeline')
+def run_command(cmd, intxt, outfile, shell=False, name='all'):
+    start = time.time()
     proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE, shell=shell)
     stdout, stderr = proc.communicate(intxt.encode('utf-8'))
-    if proc.returncode != 0:
+    THE_METRICS.observe('regtest_step_seconds', time.time() - start, step=name)
+    return finish_command(cmd, intxt, outfile, proc.returncode, stdout, stderr)
+
+def log_failure(c, intxt, outfile, stdout, stderr):
+    print('Writing stderr to test/error.log')
+    with open('test/error.log', 'ab') as fout:
+        fout.write(('Command: %s\n' % c).encode('utf-8'))
+        fout.write(('Output file: %s\n' % outfile).encode('utf-8'))
+        fout.write(('Time: %s\n' % time.asctime()).encode('utf-8'))
+        fout.write(b'Stdin:\n\n')
+        fout.write(intxt.encode('utf-8'))
+        fout.write(b'Stdout:\n\n')
+        fout.write(stdout)
+        fout.write(b'Stderr:\n\n')
+        fout.write(stderr)
+        fout.write(b'\n\n')
+
+def finish_command(cmd, intxt, outfile, returncode, stdout, stderr,
+                   quiet=False, write=True):
+    # log failures or write the output of a finished process
+    # with quiet=True, failures are only reported by the exception,
+    # whose arguments are those of log_failure()
+    if returncode != 0:
         c = cmd if isinstance(cmd, str) else ' '.join(cmd)
-        print('Failed command: %s' % c)
-        print('Writing stderr to test/error.log')
-        with open('test/error.log', 'ab') as fout:
-            fout.write(('Command: %s\n' % c).encode('utf-8'))
-            fout.write(('Output file: %s\n' % outfile).encode('utf-8'))
-            fout.write(('Time: %s\n' % time.asctime()).encode('utf-8'))
-            fout.write(b'Stdin:\n\n')
-            fout.write(intxt.encode('utf-8'))
-            fout.write(b'Stdout:\n\n')
-            fout.write(stdout)
-            fout.write(b'Stderr:\n\n')
-            fout.write(stderr)
-            fout.write(b'\n\n')
-        print('Exiting')
-        raise ErrorInPipeline(c)
-    else:
-        with open(outfile, 'wb') as fout:
-            if not intxt:
-                h = hash_line(intxt)
-                stdout = ('[%s#0]\n' % h).encode('utf-8') + stdout
-                stdout += ('\n[/%s]\n' % h).encode('utf-8')
+        if not quiet:
+            print('Failed command: %s' % c)
+            log_failure(c, intxt, outfile, stdout, stderr)
+            print('Exiting')
+        raise ErrorInPipeline(c, intxt, outfile, stdout, stderr)
+    if not intxt:
+        h = hash_line(intxt)
+        stdout = ('[%s#0]\n' % h).encode('utf-8') + stdout
+        stdout += ('\n[/%s]\n' % h).encode('utf-8')
+    if write:
+        with replace_file(outfile, 'wb') as fout:
             fout.write(stdout)
+    return stdout
 
 def ensure_dir_exists(name):
     pth = os.path.join('test', name)
     if not os.path.isdir(pth):
         os.mkdir(pth)
 
+def parse_size(s):
+    # 4G, 512M, 100k or a plain number of bytes
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    s = str(s).strip().lower().rstrip('b')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def format_size(n):
+    return '%.1f MB' % (n / (1 << 20))
+
+def limit_command(cmd, size, shell=False):
+    # cmd with its address space capped by prlimit(1), or None if that
+    # isn't installed
+    prlimit = shutil.which('prlimit')
+    if not prlimit:
+        return None
+    if shell:
+        return '%s --as=%d -- /bin/sh -c %s' % (shlex.quote(prlimit), size,
+                                                shlex.quote(cmd))
+    return [prlimit, '--as=%d' % size, '--'] + cmd
+
+def limit_memory(pid, size):
+    # caps the address space of a step which is already running, for
+    # when prlimit(1) isn't available, so it may be over the cap already
+    try:
+        import resource
+        resource.prlimit(pid, resource.RLIMIT_AS, (size, size))
+    except (ImportError, AttributeError, OSError):
+        pass
+
+def read_peak_memory(pid):
+    # (peak resident, peak virtual) of a running process in bytes,
+    # or None where /proc isn't available
+    try:
+        with open('/proc/%s/status' % pid) as fin:
+            vals = {}
+            for line in fin:
+                if line.startswith(('VmHWM:', 'VmPeak:')):
+                    key, val = line.split(':', 1)
+                    vals[key] = int(val.split()[0]) * 1024
+            return vals.get('VmHWM', 0), vals.get('VmPeak', 0)
+    except (OSError, ValueError):
+        return None
+
+def state_dir():
+    # test/.regtest holds data that is local to this checkout
+    pth = os.path.join('test', '.regtest')
+    if not os.path.isdir(pth):
+        os.makedirs(pth, exist_ok=True)
+        with open(os.path.join(pth, '.gitignore'), 'w') as fout:
+            fout.write('*\n')
+    return pth
+
+def load_state(name, default):
+    try:
+        with open(os.path.join(state_dir(), name)) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return default
+
+def save_state(name, blob):
+    with replace_file(os.path.join(state_dir(), name)) as fout:
+        json.dump(blob, fout)
+
+class FailureHistory:
+    '''How often each line has failed, kept in test/.regtest/failures.json
+    as { corpus : { step : { hash : [failures, time of last failure] } } }.
+    The time is the mtime of the output that failed, so looking at the
+    same output twice only counts once.'''
+    def __init__(self):
+        self.data = None
+        self.dirty = False
+    def load(self):
+        if self.data is None:
+            self.data = load_state('failures.json', {})
+        return self.data
+    def record(self, corpus, step, hashes, when):
+        if not hashes:
+            return
+        steps = self.load().setdefault(corpus, {})
+        ent = steps.setdefault(step, {})
+        for hsh in hashes:
+            cur = ent.get(hsh)
+            if cur and cur[1] >= when:
+                continue
+            ent[hsh] = [cur[0] + 1 if cur else 1, when]
+            self.dirty = True
+    def prune(self, corpus):
+        # forget lines which are no longer in the input of a corpus
+        # and steps which are no longer in its pipeline
+        steps = self.load().get(corpus.name)
+        if not steps:
+            return
+        ins = corpus.load_inputs()
+        for step in list(steps.keys()):
+            ent = steps[step]
+            gone = [h for h in ent if h not in ins]
+            for hsh in gone:
+                del ent[hsh]
+            if gone:
+                self.dirty = True
+            if not ent or step not in corpus.commands:
+                del steps[step]
+                self.dirty = True
+        if not steps:
+            del self.data[corpus.name]
+    def record_output(self, corpus, step, hashes):
+        # record failures in the current output of a step
+        try:
+            when = os.path.getmtime(corpus.out_name(step))
+        except OSError:
+            return
+        self.prune(corpus)
+        self.record(corpus.name, step, hashes, when)
+    def score(self, corpus, hsh):
+        count = 0
+        last = 0
+        for ent in self.load().get(corpus, {}).values():
+            if hsh in ent:
+                count += ent[hsh][0]
+                last = max(last, ent[hsh][1])
+        return count, last
+    def counts(self, corpus, hashes):
+        # { hash : failures } for the hashes which have failed before
+        ret = {}
+        for hsh in hashes:
+            n = self.score(corpus, hsh)[0]
+            if n:
+                ret[hsh] = n
+        return ret
+    def order(self, corpus, hashes):
+        # most frequently and most recently failed first, otherwise stable
+        if not self.load().get(corpus):
+            return list(hashes)
+        return sorted(hashes, key=lambda h: self.score(corpus, h), reverse=True)
+    def save(self):
+        if self.dirty:
+            save_state('failures.json', self.data)
+            self.dirty = False
+
+THE_FAILURE_HISTORY = FailureHistory()
+
+def save_crashed(crashed):
+    # crashed is { corpus : [hash] } of the lines which crashed a step in
+    # the latest run of each corpus, kept in test/.regtest/crashed.json
+    # since their outputs are only entries saying so
+    known = load_state('crashed.json', {})
+    for name, hashes in crashed.items():
+        if hashes:
+            known[name] = hashes
+        else:
+            known.pop(name, None)
+    save_state('crashed.json', known)
+
 class Step:
     prognames = {
         'cg-proc': 'disam',
@@ -273,21 +1170,24 @@ class Step:
                 for op in Step.morphmodes:
                     if op in self.args:
                         self.name = Step.morphmodes[op]
-    def run(self, in_name, out_name, first=False):
+    def command(self):
         cmd = [self.prog]
         if self.prog in Step.prognames or self.prog in ['lt-proc', 'hfst-proc']:
             if self.prog not in ['cg-conv', 'vislcg3']:
                 cmd.append('-z')
         cmd += self.args # -z needs to be before file names
+        return cmd
+    def run(self, in_name, out_name, first=False, hashes=None):
+        cmd = self.command()
         txt = ''
         if first:
-            txt = load_input_string(in_name)
+            txt = load_input_string(in_name, hashes)
         else:
             with open(in_name, 'r') as fin:
                 txt = fin.read()
         if self.prog == 'vislcg3':
             txt = txt.replace('\0', '\n<STREAMCMD:FLUSH>\n')
-        run_command(cmd, txt, out_name)
+        run_command(cmd, txt, out_name, name=self.name)
 
 class Mode:
     all_modes = {}
@@ -302,23 +1202,28 @@ class Mode:
                 s.name += str(nm[s.name])
             self.commands[s.name] = i
         Mode.all_modes[self.name] = self
-    def run(self, corpusname, filename, start=None, flat=True):
-        fname = 'test/'
-        if flat:
-            fname += '%s-%s-output.txt'
+    def run(self, corpusname, filename, start=None, flat=True, outdir=None,
+            hashes=None):
+        if outdir:
+            fname = os.path.join(outdir, '%s-%s-output.txt')
+        elif flat:
+            fname = 'test/%s-%s-output.txt'
         else:
             ensure_dir_exists('output')
-            fname += 'output/%s-%s.txt'
+            fname = 'test/output/%s-%s.txt'
         fin = filename
         idx = self.commands.get(start, 0)
         for i, step in enumerate(self.steps[idx:]):
             fout = fname % (corpusname, step.name)
-            step.run(fin, fout, first=(i == 0))
+            step.run(fin, fout, first=(i == 0), hashes=hashes)
             fin = fout
     def get_commands(self):
         return [s.name for s in self.steps]
+    def get_steps(self, start=None):
+        return self.steps[self.commands.get(start, 0):]
 
 def load_modes():
+    import xml.etree.ElementTree
     try:
         root = xml.etree.ElementTree.parse('modes.xml').getroot()
     except FileNotFoundError:
@@ -387,8 +1292,272 @@ def check_git():
         print('Cloning failed. Please check the remote url and try again.')
         sys.exit(1)
 
+FILE_DIGESTS = {} # { path : (size, mtime, digest) }
+
+def file_digest(path):
+    # digest of a data file referenced by a pipeline, or b'' if the
+    # argument isn't a file
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return b''
+    if not os.path.isfile(path):
+        return b''
+    known = FILE_DIGESTS.get(path)
+    if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+        return known[2]
+    h = hashlib.sha256(path.encode('utf-8'))
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            h.update(block)
+    FILE_DIGESTS[path] = (st.st_size, st.st_mtime_ns, h.digest())
+    return FILE_DIGESTS[path][2]
+
+SHARED_LIBRARIES = {} # { program : [library paths] }
+
+def shared_libraries(prog):
+    # the libraries a program is linked against, as far as ldd knows
+    if prog not in SHARED_LIBRARIES:
+        libs = []
+        if shutil.which('ldd'):
+            proc = subprocess.run(['ldd', prog], stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL,
+                                  universal_newlines=True)
+            for line in proc.stdout.splitlines():
+                # libfoo.so.1 => /usr/lib/libfoo.so.1 (0x...)
+                parts = line.split('=>')
+                if len(parts) == 2 and parts[1].split():
+                    lib = parts[1].split()[0]
+                    if os.path.isfile(lib):
+                        libs.append(lib)
+        SHARED_LIBRARIES[prog] = sorted(libs)
+    return SHARED_LIBRARIES[prog]
+
+def is_script(path):
+    try:
+        with open(path, 'rb') as fin:
+            return fin.read(2) == b'#!'
+    except OSError:
+        return False
+
+class ResultCache:
+    '''Outputs of Corpus.run() shared between checkouts, stored as
+    DIR/ab/abcdef.../STEP.txt and keyed by Corpus.cache_key().'''
+    version = 'apertium-regtest-cache-2'
+    def __init__(self, path):
+        self.path = path
+    @staticmethod
+    def from_env():
+        path = os.environ.get('AP_REGTEST_CACHE_DIR', '')
+        if not path:
+            return None
+        os.makedirs(path, exist_ok=True)
+        return ResultCache(path)
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+    def fetch(self, key, corpus):
+        ent = self.entry(key)
+        if not os.path.isdir(ent):
+            return False
+        steps = corpus.run_outputs()
+        # check everything first, so that a broken entry doesn't leave
+        # a mix of cached and old outputs
+        if not all(os.path.isfile(os.path.join(ent, c + '.txt'))
+                   for c in steps):
+            return False
+        if not Corpus.flat:
+            ensure_dir_exists('output')
+        for c in steps:
+            src = os.path.join(ent, c + '.txt')
+            dest = corpus.out_name(c)
+            tmp = temp_name(dest)
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dest)
+        try:
+            # mark as recently used for `apertium-regtest gc`
+            os.utime(ent)
+        except OSError:
+            pass
+        return True
+    def store(self, key, corpus):
+        ent = self.entry(key)
+        if os.path.isdir(ent):
+            return
+        os.makedirs(os.path.dirname(ent), exist_ok=True)
+        # fill a private directory and rename it into place, so that
+        # concurrent readers never see a partial entry
+        tmp = tempfile.mkdtemp(prefix='%s.tmp-' % key, dir=os.path.dirname(ent))
+        try:
+            for c in corpus.run_outputs():
+                if os.path.isfile(corpus.out_name(c)):
+                    shutil.copyfile(corpus.out_name(c),
+                                    os.path.join(tmp, c + '.txt'))
+            os.rename(tmp, ent)
+        except OSError:
+            # most likely someone else stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+    def gc(self, max_age=None, max_size=None):
+        now = time.time()
+        entries = []
+        removed = 0
+        for sub in os.listdir(self.path):
+            subdir = os.path.join(self.path, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                ent = os.path.join(subdir, name)
+                try:
+                    age = now - os.stat(ent).st_mtime
+                    size = sum(os.path.getsize(os.path.join(ent, f))
+                               for f in os.listdir(ent))
+                except OSError:
+                    continue
+                if '.tmp-' in name:
+                    # abandoned partial entry
+                    if age > 3600:
+                        shutil.rmtree(ent, ignore_errors=True)
+                    continue
+                if max_age is not None and age > max_age:
+                    shutil.rmtree(ent, ignore_errors=True)
+                    removed += 1
+                    continue
+                entries.append((age, size, ent))
+        total = sum(e[1] for e in entries)
+        if max_size is not None:
+            entries.sort(reverse=True)
+            while entries and total > max_size:
+                age, size, ent = entries.pop(0)
+                shutil.rmtree(ent, ignore_errors=True)
+                total -= size
+                removed += 1
+        print('Removed %s cache entries, %s remaining (%.1f MB)' % (removed, len(entries), total / (1 << 20)))
+
+class TeeStream:
+    '''Writes to a stream while keeping a copy of what was written.'''
+    def __init__(self, stream):
+        self.stream = stream
+        self.parts = []
+    def write(self, s):
+        # the progress line is redrawn with \r and isn't part of the output
+        if not s.startswith('\r'):
+            self.parts.append(s)
+        return self.stream.write(s)
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Manifest:
+    '''Digests of the files which determine the result of `test`, along
+    with the report it printed, kept in test/.regtest/manifest.json so
+    that when nothing has changed the report can be repeated without
+    loading modes or running any pipelines.'''
+    version = 1
+    def __init__(self, key):
+        self.key = key # the options which affect the report
+        self.last = load_state('manifest.json', {})
+        if self.last.get('version') != Manifest.version:
+            self.last = {}
+        self.files = {} # { path : [size, mtime, digest] or None }
+        self.stats = {} # { path : (size, mtime) } before the run
+        self.report = ''
+        self.complete = True # whether record() found every file
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return (st.st_size, st.st_mtime_ns)
+    @staticmethod
+    def entry(st, dgst):
+        # as in index_input(), a file changed just now could change
+        # again without changing mtime, so it gets hashed next time
+        if time.time_ns() - st[1] < 2 * 10**9:
+            return [st[0], None, dgst]
+        return [st[0], st[1], dgst]
+    def digest(self, path, st):
+        old = self.last.get('files', {}).get(path)
+        if old and old[0] == st[0] and old[1] == st[1]:
+            return old[2]
+        return file_digest(path).hex()
+    def fresh(self):
+        # whether the last run had the same options and no file it
+        # depended on has changed since
+        if self.last.get('key') != self.key:
+            return False
+        files = {}
+        for path, old in self.last['files'].items():
+            st = Manifest.stat(path)
+            if old is None or st is None:
+                if old is not st:
+                    return False
+                files[path] = None
+                continue
+            dgst = self.digest(path, st)
+            if dgst != old[2]:
+                return False
+            files[path] = Manifest.entry(st, dgst)
+        if files != self.last['files']:
+            # only timestamps changed, so next time stat() is enough
+            self.last['files'] = files
+            save_state('manifest.json', self.last)
+        return True
+    def record(self):
+        # the files of every loaded corpus, before any of them are read
+        # if some pipeline may read files that can't be listed, nothing
+        # is saved and the next run can't be skipped
+        paths = ['modes.xml', 'test/tests.json', os.path.realpath(__file__)]
+        for corp in Corpus.all_corpora.values():
+            if corp.infile:
+                paths.append(corp.infile)
+            for c in corp.command_list:
+                for fname in [corp.exp_name(c), corp.gold_name(c)]:
+                    paths.append(split_member(fname)[0] or fname)
+            files = corp.pipeline_files()
+            if files is None:
+                self.complete = False
+                return
+            paths += files
+        for path in paths:
+            st = Manifest.stat(path)
+            self.stats[path] = st
+            self.files[path] = (Manifest.entry(st, self.digest(path, st))
+                                if st else None)
+    @contextmanager
+    def capture(self):
+        stream = sys.stdout
+        sys.stdout = TeeStream(stream)
+        try:
+            yield
+        finally:
+            self.report = ''.join(sys.stdout.parts)
+            sys.stdout = stream
+    def save(self, status):
+        if not self.complete:
+            return
+        if any(Manifest.stat(p) != st for p, st in self.stats.items()):
+            return # something was changed while the tests ran
+        save_state('manifest.json', {
+            'version': Manifest.version,
+            'key': self.key,
+            'files': self.files,
+            'status': status,
+            'report': self.report
+        })
+
+def added_deleted(ins, outs):
+    # hashes of the inputs with no expected output and of the expected
+    # outputs with no input
+    add = [k for k in ins if k not in outs]
+    delete = [k for k in outs if k not in ins]
+    add.sort(key = lambda x: ins[x][0])
+    delete.sort()
+    return add, delete
+
 class Corpus:
     flat = True
+    packed = False
     all_corpora = {}
     def __init__(self, name, blob):
         self.name = name
@@ -414,6 +1583,10 @@ class Corpus:
         self.start_step = blob.get('start-step', None)
         self.data = {}
         self.loaded = False
+        self.inputs = None
+        self.live = None # LiveCheck of the last run, if any
+        self.add_del = None # (key, added_deleted()) for summary()
+        self.crashed = None # see crashed_lines()
         self.unsaved = set()
         self.command_list = ['all']
         if self.mode:
@@ -429,22 +1602,131 @@ class Corpus:
         if not isinstance(self.relevant_commands, list):
             print('Corpus %s specified a non-list for "relevant"' % self.name)
             sys.exit(1)
+        self.normalize = blob.get('normalize', [])
+        if not isinstance(self.normalize, list):
+            print('Corpus %s specified a non-list for "normalize"' % self.name)
+            sys.exit(1)
+        for n in self.normalize:
+            if n not in normalizations:
+                print('Unknown normalization %s in corpus %s' % (n, self.name))
+                print('Available normalizations: %s' % ', '.join(sorted(normalizations)))
+                sys.exit(1)
+        # { step : bytes }, from either a size for every step or an
+        # object of sizes by step
+        self.memory_limits = {}
+        lim = blob.get('memory-limit', {})
+        try:
+            if isinstance(lim, dict):
+                for c, v in lim.items():
+                    if c not in self.command_list:
+                        print('Unknown step %s in "memory-limit" of corpus %s' % (c, self.name))
+                        sys.exit(1)
+                    self.memory_limits[c] = parse_size(v)
+            else:
+                size = parse_size(lim)
+                self.memory_limits = {c: size for c in self.command_list}
+        except ValueError:
+            print('Corpus %s specified an invalid size in "memory-limit"' % self.name)
+            sys.exit(1)
         self.hashes = []
         Corpus.all_corpora[name] = self
     def __len__(self):
+        self.load_inputs()
         return len(self.hashes)
+    def load_inputs(self):
+        # only the input file is read here, so that interactive modes
+        # can count lines without parsing every output of every step
+        if self.inputs is not None:
+            return self.inputs
+        if self.infile:
+            self.inputs = load_input(self.infile)
+        else:
+            self.inputs = {hash_line(''): [0, '']}
+        self.hashes = list(self.inputs.keys())
+        self.hashes.sort(key = lambda x: self.inputs[x][0])
+        return self.inputs
+    def crashed_lines(self):
+        # the lines which crashed a step in the latest run, see save_crashed()
+        if self.crashed is None:
+            self.crashed = load_state('crashed.json', {}).get(self.name, [])
+        return set(self.crashed)
+    def input_digest(self):
+        # identifies the input as load_inputs() reads it, so that a worker
+        # with a different copy of it can refuse to run a job
+        ins = self.load_inputs()
+        h = hashlib.sha256()
+        for hsh in self.hashes:
+            h.update(('%s#%s\n' % (hsh, ins[hsh][0])).encode('utf-8'))
+        return h.hexdigest()
     def run(self):
+        run_corpora([self])
+    def cache_key(self):
+        # everything that determines the outputs of run(), or None if
+        # that can't be known, see pipeline_files()
+        files = self.pipeline_files()
+        if files is None:
+            return None
+        h = hashlib.sha256(ResultCache.version.encode('utf-8'))
+        for step in Mode.all_modes[self.mode].get_steps(self.start_step):
+            h.update(json.dumps([step.name, step.command()]).encode('utf-8'))
+        for fname in files:
+            h.update(file_digest(fname))
+        if self.infile:
+            h.update(load_input_string(self.infile).encode('utf-8'))
+        return h.hexdigest()
+    def pipeline_files(self):
+        # the programs run() starts, their shared libraries, and the
+        # arguments naming files, or None if the pipeline may read files
+        # which can't be listed: shell commands, scripts, directories
+        if not self.mode:
+            return None
+        ret = []
+        for step in Mode.all_modes[self.mode].get_steps(self.start_step):
+            cmd = step.command()
+            prog = shutil.which(cmd[0])
+            if not prog or is_script(prog):
+                return None
+            ret.append(prog)
+            ret += shared_libraries(prog)
+            for arg in cmd[1:]:
+                if os.path.isdir(arg):
+                    return None
+                if os.path.isfile(arg):
+                    ret.append(arg)
+        return ret
+    def run_outputs(self):
+        # steps whose output files are written by run()
+        if self.mode:
+            return [s.name for s in Mode.all_modes[self.mode].get_steps(self.start_step)]
+        return ['all']
+    def run_shard(self, hashes, outdir):
+        # run only some lines, writing the outputs to outdir
+        # returns { step : file name }
         if self.mode:
             Mode.all_modes[self.mode].run(self.name, self.infile,
                                           start=self.start_step,
-                                          flat=Corpus.flat)
+                                          outdir=outdir, hashes=hashes)
         else:
             txt = ''
             if self.infile:
-                txt = load_input_string(self.infile)
-            run_command(self.shell, txt, self.out_name('all'), shell=True)
-        self.loaded = False
+                txt = load_input_string(self.infile, hashes)
+            run_command(self.shell, txt,
+                        os.path.join(outdir, '%s-all-output.txt' % self.name),
+                        shell=True)
+        ret = {}
+        for c in self.command_list:
+            fname = os.path.join(outdir, '%s-%s-output.txt' % (self.name, c))
+            if os.path.isfile(fname):
+                ret[c] = fname
+        return ret
+    def pack_name(self):
+        if Corpus.flat:
+            return 'test/%s.pack' % self.name
+        else:
+            return 'test/expected/%s.pack' % self.name
     def exp_name(self, cmd):
+        if Corpus.packed:
+            return '%s#expected/%s' % (self.pack_name(), cmd)
         if Corpus.flat:
             return 'test/%s-%s-expected.txt' % (self.name, cmd)
         else:
@@ -455,47 +1737,76 @@ class Corpus:
         else:
             return 'test/output/%s-%s.txt' % (self.name, cmd)
     def gold_name(self, cmd):
+        if Corpus.packed:
+            return '%s#gold/%s' % (self.pack_name(), cmd)
         if Corpus.flat:
             return 'test/%s-%s-gold.txt' % (self.name, cmd)
         else:
             return 'test/gold/%s-%s.txt' % (self.name, cmd)
+    def normalizer_names(self, cmd, presorted=False):
+        names = [n for n in self.normalize if n != 'sort']
+        if not presorted and (cmd in self.sort or 'sort' in self.normalize):
+            names.insert(0, 'sort')
+        return names
+    def normalizer(self, cmd, presorted=False):
+        return make_normalizer(self.normalizer_names(cmd, presorted))
+    def load_tasks(self):
+        # arguments of parse_step_files() for each step
+        return [(self.out_name(c), self.exp_name(c), self.gold_name(c),
+                 c in self.sort, self.normalizer_names(c, c in self.sort),
+                 self.normalizer_names(c))
+                for c in self.command_list]
     def save(self):
         if not Corpus.flat:
             ensure_dir_exists('expected')
-        for blob in self.data['cmds']:
-            if blob['cmd'] in self.unsaved:
-                save_output(self.exp_name(blob['cmd']), blob['expect'])
+        save_outputs({self.exp_name(blob['cmd']): blob['expect']
+                      for blob in self.data['cmds']
+                      if blob['cmd'] in self.unsaved})
         self.unsaved = set()
-    def load(self):
+    def load(self, parsed=None):
+        # parsed is the result of parse_step_files() for each step, if
+        # the files have already been read elsewhere
         if self.loaded:
             return
-        if self.infile:
-            ins = load_input(self.infile)
-        else:
-            ins = {hash_line(''): [0, '']}
-        self.hashes = list(ins.keys())
-        self.hashes.sort(key = lambda x: ins[x][0])
+        start = time.time()
+        ins = self.load_inputs()
         outs = []
+        created = {} # expected files that didn't exist yet
+        # a crash is never what a line is expected to do
+        crashed = self.crashed_lines()
         self.data = {
             'inputs': ins,
             'cmds': [],
             'count': len(ins)
         }
-        for c in self.command_list:
+        for i, c in enumerate(self.command_list):
+            got = parsed[i] if parsed else {}
             expfile = self.exp_name(c)
-            outdata = load_output(self.out_name(c),
-                                  should_sort_analyses=(c in self.sort))
-            expdata = {}
-            if os.path.isfile(expfile):
-                expdata = load_output(expfile)
+            norm = self.normalizer(c)
+            if 'output' in got:
+                outdata = got['output']
+            else:
+                outdata = load_output(self.out_name(c),
+                                      should_sort_analyses=(c in self.sort),
+                                      normalize=self.normalizer(c, c in self.sort))
+            expdata = OutputDict()
+            if output_exists(expfile):
+                if 'expect' in got:
+                    expdata = got['expect']
+                else:
+                    expdata = load_output(expfile, normalize=norm)
+            elif crashed:
+                expdata = OutputDict((h, outdata[h]) for h in outdata
+                                     if h not in crashed)
+                created[expfile] = expdata
             else:
-                if not Corpus.flat:
-                    ensure_dir_exists('expected')
-                save_output(expfile, outdata)
+                created[expfile] = outdata
                 expdata = outdata
             golddata = {}
             goldfile = self.gold_name(c)
-            if os.path.isfile(goldfile):
+            if 'gold' in got:
+                golddata = got['gold']
+            elif output_exists(goldfile):
                 golddata = load_gold(goldfile)
             if not outs:
                 outs = expdata.keys()
@@ -506,20 +1817,59 @@ class Corpus:
                 'output': outdata,
                 'expect': expdata,
                 'gold': golddata,
+                'gold_digests': gold_digests(golddata, norm),
                 'trace': {} # TODO?
             })
+        if created:
+            if not Corpus.flat:
+                ensure_dir_exists('expected')
+            save_outputs(created)
 
-        add = [k for k in ins if k not in outs]
-        delete = [k for k in outs if k not in ins]
-        add.sort(key = lambda x: ins[x][0])
-        delete.sort()
-        self.data['add'] = add
-        self.data['del'] = delete
-    def page(self, start, page_len):
-        hs = self.hashes[start:start+page_len]
+        share_entries([blob[k] for blob in self.data['cmds']
+                       for k in ['expect', 'output']])
+        self.find_changes()
+        self.data['add'], self.data['del'] = added_deleted(ins, outs)
+        self.loaded = True
+        THE_METRICS.observe('regtest_corpus_load_seconds', time.time() - start,
+                            corpus=self.name)
+    def summary(self):
+        # placeholder for corpora that are not on the current page, with
+        # the added and deleted lines, which are shown for every corpus
+        if self.loaded:
+            add, delete = self.data['add'], self.data['del']
+        else:
+            expfile = self.exp_name(self.command_list[0])
+            pth = split_member(expfile)[0] or expfile
+            key = (id(self.load_inputs()), Manifest.stat(pth))
+            if self.add_del is None or self.add_del[0] != key:
+                outs = {}
+                if key[1]:
+                    outs = set(output_keys(expfile))
+                self.add_del = (key, added_deleted(self.inputs, outs))
+            add, delete = self.add_del[1]
+        return {
+            'summary': True,
+            'count': len(self),
+            'add': add,
+            'del': delete
+        }
+    def page(self, start, page_len, hs=None):
+        # the lines [start, start+page_len) or, when given, the lines hs
+        if hs is None:
+            hs = self.hashes[start:start+page_len]
+        changes = self.data['changes']
         def hf(dct):
             nonlocal hs
-            return {k:v for k, v in dct.items() if k in hs}
+            return {k:dct[k][:2] for k in hs if k in dct}
+        def changed(i, blob):
+            nonlocal hs
+            return {k:True for k in hs
+                    if changes.get(k, 0) & (1 << i) and k in blob['output']}
+        def matched(blob):
+            nonlocal hs
+            return {k:True for k in hs
+                    if k in blob['output'] and
+                    blob['output'].digest(k) in blob['gold_digests'].get(k, ())}
         return {
             'inputs': hf(self.data['inputs']),
             'cmds': [
@@ -529,44 +1879,123 @@ class Corpus:
                     'relevant': blob['relevant'],
                     'output': hf(blob['output']),
                     'expect': hf(blob['expect']),
-                    'gold': hf(blob['gold']),
+                    'gold': {k:blob['gold'][k] for k in hs if k in blob['gold']},
+                    'changed': changed(i, blob),
+                    'matched_gold': matched(blob),
                     'trace': hf(blob['trace'])
                 }
-                for blob in self.data['cmds']
+                for i, blob in enumerate(self.data['cmds'])
             ],
-            'count': page_len,
+            'first': {k:self.data['first'].get(k) for k in hs if k in changes},
+            'steps': dict(self.data['steps']),
+            'count': len(hs),
             'add': self.data['add'],
-            'del': self.data['del']
+            'del': self.data['del'],
+            'history': THE_FAILURE_HISTORY.counts(self.name, hs)
         }
     def step(self, s):
         return self.data['cmds'][self.commands.get(s, -1)]
+    @phase('comparison')
+    def find_changes(self, hashes=None):
+        # self.data['changes'] is { hash : bitmask of the steps where the
+        # output differs from the expected output } for the lines which
+        # changed at all, found in one pass over all steps, or updated
+        # for just the given hashes
+        changes = self.data.setdefault('changes', {})
+        if hashes is None:
+            changes.clear()
+            self.data['first'] = {}
+            self.data['steps'] = {}
+        else:
+            for hsh in hashes:
+                changes.pop(hsh, None)
+        ins = self.data['inputs']
+        for i, blob in enumerate(self.data['cmds']):
+            out = blob['output']
+            exp = blob['expect']
+            for hsh in (exp if hashes is None else hashes):
+                if hsh not in ins or hsh not in exp:
+                    continue
+                if hsh not in out or not same_entry(out, exp, hsh):
+                    changes[hsh] = changes.get(hsh, 0) | (1 << i)
+        for hsh in (changes if hashes is None else hashes):
+            self.index_first(hsh)
+    def index_first(self, hsh):
+        # keep self.data['first'] as { hash : first_change() } and
+        # self.data['steps'] as { step : number of those hashes }, so that
+        # pages don't have to look at every change
+        first = self.data['first']
+        steps = self.data['steps']
+        old = first.pop(hsh, None)
+        if old:
+            steps[old] -= 1
+            if not steps[old]:
+                del steps[old]
+        new = self.first_change(hsh)
+        if new:
+            first[hsh] = new
+            steps[new] = steps.get(new, 0) + 1
+    @staticmethod
+    def matches_gold(blob, hsh):
+        out = blob['output']
+        d = out.digest(hsh) if hsh in out else None
+        return d in blob['gold_digests'].get(hsh, ())
+    def first_change(self, hsh):
+        # the first step where the output of hsh differs and doesn't
+        # match gold, as in changed_in_step(), or None
+        mask = self.data['changes'].get(hsh, 0)
+        while mask:
+            i = (mask & -mask).bit_length() - 1
+            if not Corpus.matches_gold(self.data['cmds'][i], hsh):
+                return self.command_list[i]
+            mask &= mask - 1
+        return None
+    def changes_by_step(self, hashes=None):
+        # { step : changed hashes whose first change is in that step }
+        ret = defaultdict(list)
+        first = self.data['first']
+        for hsh in (first if hashes is None else hashes):
+            if hsh in first:
+                ret[first[hsh]].append(hsh)
+        return ret
+    def changed_in_step(self, blob):
+        # only lines with the step's bit set can have changed
+        bit = 1 << self.commands[blob['cmd']]
+        return {hsh for hsh, mask in self.data['changes'].items()
+                if mask & bit and not Corpus.matches_gold(blob, hsh)}
+    @phase('comparison')
     def get_changed_hashes(self):
         norm = set()
         imp = set()
         for cmd in self.relevant_commands:
             blob = self.step(cmd)
-            for hsh in self.data['inputs']:
-                if hsh not in blob['expect']:
-                    continue
-                if blob['output'][hsh][1] == blob['expect'][hsh][1]:
-                    continue
-                if hsh in blob['gold']:
-                    if blob['output'][hsh][1] in blob['gold'][hsh]:
-                        continue
-                norm.add(hsh)
-                if blob['relevant']:
-                    imp.add(hsh)
+            changed = self.changed_in_step(blob)
+            THE_FAILURE_HISTORY.record_output(self, cmd, changed)
+            norm.update(changed)
+            if blob['relevant']:
+                imp.update(changed)
         imp_ret = sorted(imp, key = lambda x: self.data['inputs'][x][0])
         norm -= imp
         norm_ret = sorted(norm, key = lambda x: self.data['inputs'][x][0])
+        THE_FAILURE_HISTORY.save()
         return imp_ret + norm_ret
+    def diff_line(self, hsh, step=None):
+        self.load()
+        blob = self.step(step)
+        if hsh not in blob['expect'] or hsh not in blob['output']:
+            return None
+        exp = blob['expect'][hsh]
+        out = blob['output'][hsh]
+        return diff_outputs(exp[1], out[1], (exp[2], out[2]))
     def display_line(self, hsh, step=None):
-        # TODO: colors, diffs
         def indent(s):
             print('  ' + s.replace('\n', '\n  '))
         blob = self.step(step)
         if hsh in self.data['inputs']:
             print('%s %s of %s' % (self.name, self.hashes.index(hsh)+1, len(self.hashes)))
+            first = self.first_change(hsh)
+            if first:
+                print('FIRST CHANGED IN: %s' % first)
             print('INPUT:')
             indent(self.data['inputs'][hsh][1])
         else:
@@ -580,6 +2009,11 @@ class Corpus:
         if hsh in blob['output']:
             print('ACTUAL OUTPUT:')
             indent(blob['output'][hsh][1])
+        if (hsh in blob['expect'] and hsh in blob['output'] and
+            blob['expect'].digest(hsh) != blob['output'].digest(hsh)):
+            print('DIFF:')
+            indent(format_diff(self.diff_line(hsh, step),
+                               color=sys.stdout.isatty()))
         if hsh in blob['gold']:
             print('IDEAL OUTPUTS:')
             for g in blob['gold'][hsh]:
@@ -591,7 +2025,8 @@ class Corpus:
         for blob in self.data['cmds']:
             for a in self.data['add']:
                 if a not in blob['expect']:
-                    blob['expect'][a] = [0, blob['output'][a][1]]
+                    # shared rather than copied, as in share_entries()
+                    blob['expect'][a] = blob['output'][a]
                     changes.append(a)
                     self.unsaved.add(blob['cmd'])
             for d in self.data['del']:
@@ -601,10 +2036,12 @@ class Corpus:
                     self.unsaved.add(blob['cmd'])
                 if d in blob['gold']:
                     del blob['gold'][d]
+                    del blob['gold_digests'][d]
         if should_save:
             self.save()
         self.data['add'] = []
         self.data['del'] = []
+        self.find_changes(set(changes))
         return list(set(changes))
     def accept(self, hashes=None, last_step=None):
         if 'cmds' not in self.data:
@@ -615,20 +2052,74 @@ class Corpus:
                 if h not in blob['expect']:
                     continue
                 if blob['expect'][h][1] != blob['output'][h][1]:
-                    blob['expect'][h][1] = blob['output'][h][1]
+                    blob['expect'][h] = blob['output'][h]
                     changes.append(h)
                     self.unsaved.add(blob['cmd'])
             if blob['cmd'] == last_step:
                 break
         self.save()
+        self.find_changes(set(changes))
         return list(set(changes))
+    def accept_step(self, step, last_step=None):
+        # accept every line whose first change is in step
+        hashes = self.changes_by_step().get(step)
+        if not hashes:
+            return []
+        return self.accept(hashes, last_step)
     def set_gold(self, hsh, vals, step=None):
         blob = self.step(step)
         blob['gold'][hsh] = vals
-        if not Corpus.flat:
+        blob['gold_digests'].update(
+            gold_digests({hsh: vals}, self.normalizer(blob['cmd'])))
+        # matching gold can move the first change of the line
+        self.index_first(hsh)
+        if not Corpus.flat and not Corpus.packed:
             ensure_dir_exists('gold')
         save_gold(self.gold_name(blob['cmd']), blob['gold'])
 
+def parse_step_files(task):
+    # read the output, expected and gold files of one step, usually in
+    # a worker process of load_in_parallel()
+    outfile, expfile, goldfile, sort, out_norm, exp_norm = task
+    ret = {'gold': load_gold(goldfile)}
+    def small(fname):
+        # large files are mapped by the parent instead
+        return os.path.isfile(fname) and os.path.getsize(fname) < MMAP_THRESHOLD
+    if small(outfile):
+        ret['output'] = load_output(outfile, should_sort_analyses=sort,
+                                    normalize=make_normalizer(out_norm))
+    if small(expfile):
+        ret['expect'] = load_output(expfile, normalize=make_normalizer(exp_norm))
+    return ret
+
+# below this many bytes of files, starting worker processes isn't worth it
+PARALLEL_LOAD_THRESHOLD = 4 << 20
+
+def load_in_parallel(corpora):
+    # Corpus.load() for several corpora, with the files parsed by a
+    # process pool of up to Scheduler.jobs workers
+    todo = [c for c in corpora if not c.loaded]
+    tasks = [t for c in todo for t in c.load_tasks()]
+    # packed files hold every step of a corpus, so count them once
+    paths = set(split_member(fname)[0] or fname
+                for t in tasks for fname in t[:3])
+    size = sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+    # forking a process with other threads running, such as the web
+    # server's, can deadlock the children
+    if (len(tasks) < 2 or Scheduler.jobs < 2 or size < PARALLEL_LOAD_THRESHOLD
+        or threading.active_count() > 1):
+        for c in todo:
+            c.load()
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(Scheduler.jobs, len(tasks))) as pool:
+        results = list(pool.map(parse_step_files, tasks))
+    i = 0
+    for c in todo:
+        n = len(c.command_list)
+        c.load(results[i:i+n])
+        i += n
+
 def load_corpora(names, static=False):
     if not os.path.isdir('test') or not os.path.isfile('test/tests.json'):
         if os.path.isdir('.git'):
@@ -650,6 +2141,8 @@ def load_corpora(names, static=False):
             for k in blob:
                 if k == 'settings':
                     Corpus.flat = (blob[k].get('structure', 'flat') != 'nested')
+                    Corpus.packed = (blob[k].get('storage', 'files') == 'packed')
+                    Pack.delta = blob[k].get('delta', False)
                     continue
                 for p in pats:
                     if p.search(k):
@@ -659,42 +2152,560 @@ def load_corpora(names, static=False):
             print('test/tests.json is not a valid JSON document. First error on line %s' % e.lineno)
             sys.exit(1)
 
+class Scheduler:
+    '''Runs the pipelines of several corpora at once, with at most
+    Scheduler.jobs processes alive at any time. Corpora which took
+    longest on previous runs are started first.'''
+    jobs = os.cpu_count() or 1
+    chunk_size = 0 # if set, run corpora this many lines at a time
+    memory_budget = None # bytes that running steps are expected to need
+    def __init__(self, corpora, on_done=None, live=False, sample=None,
+                 outdir=None):
+        # on_done(corpus) is called as each corpus finishes
+        # with live=True, final outputs are compared as they arrive
+        # and the results are left in corpus.live
+        # sample = { corpus : [hash, ...] } runs only those lines and
+        # writes the outputs to outdir instead of test/
+        self.on_done = on_done
+        self.sample = sample
+        self.outdir = outdir
+        self.live = {}
+        self.progress = None
+        self.durations = load_state('durations.json', {})
+        # { corpus : { step : peak resident bytes } }
+        self.memory = load_state('memory.json', {})
+        self.crashed = {} # { corpus : [hash] } for save_crashed()
+        self.in_use = 0
+        self.available = None
+        self.cache = ResultCache.from_env()
+        self.keys = {}
+        self.pending = []
+        self.cached = []
+        for corpus in corpora:
+            # the outputs, and maybe the inputs, are about to change
+            corpus.loaded = False
+            corpus.inputs = None
+            corpus.live = None
+            if self.cache and not sample:
+                key = corpus.cache_key()
+                if key is None:
+                    # pipelines whose inputs can't be listed always run
+                    self.pending.append(corpus)
+                    continue
+                if self.cache.fetch(key, corpus):
+                    THE_METRICS.inc('regtest_cache_hits_total', cache='result')
+                    print('Using cached outputs for %s' % corpus.name)
+                    # only complete runs are cached
+                    self.record_crashed(corpus, [])
+                    self.cached.append(corpus)
+                    continue
+                THE_METRICS.inc('regtest_cache_misses_total', cache='result')
+                self.keys[corpus.name] = key
+            self.pending.append(corpus)
+        # longest first; corpora we haven't timed go before all others
+        self.pending.sort(key=self.estimate, reverse=True)
+        if live:
+            for corpus in self.pending:
+                check = LiveCheck.create(corpus)
+                if check:
+                    self.live[corpus.name] = check
+            self.progress = Progress(list(self.live.values()))
+    def estimate(self, corpus):
+        if corpus.name in self.durations:
+            return (0, self.durations[corpus.name])
+        size = 0
+        if corpus.infile and os.path.isfile(corpus.infile):
+            size = os.path.getsize(corpus.infile)
+        return (1, size)
+    def record_crashed(self, corpus, hashes):
+        # samples don't replace the outputs in test/
+        if not self.sample and not self.outdir:
+            corpus.crashed = hashes
+            self.crashed[corpus.name] = hashes
+    def out_name(self, corpus, step):
+        if self.outdir:
+            return os.path.join(self.outdir, '%s-%s-output.txt' % (corpus.name, step))
+        return corpus.out_name(step)
+    def lines(self, corpus):
+        if self.sample:
+            return self.sample.get(corpus.name, [])
+        return corpus.hashes
+    def expected_memory(self, corpus):
+        # steps run one at a time, so the largest one is what counts
+        known = self.memory.get(corpus.name, {})
+        return max([known.get(c, corpus.memory_limits.get(c, 0))
+                    for c in corpus.command_list] + [0])
+    async def run_process(self, cmd, intxt, outfile, shell=False, name='all',
+                          quiet=False, write=True, on_output=None,
+                          corpus=None):
+        # on_output(data) is called with blocks of stdout as they arrive
+        import asyncio
+        start = time.time()
+        limit = corpus.memory_limits.get(name) if corpus else None
+        # preexec_fn isn't safe with threads, which the web server has,
+        # so the limit is set by a wrapper or after starting the step
+        limited = limit_command(cmd, limit, shell) if limit else None
+        if shell:
+            proc = await asyncio.create_subprocess_shell(
+                limited or cmd, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                *(limited or cmd), stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if limit and not limited:
+            limit_memory(proc.pid, limit)
+        peak = [0, 0]
+        watcher = asyncio.ensure_future(self.watch_memory(proc.pid, peak))
+        try:
+            if on_output:
+                stdout, stderr = await self.stream(proc, intxt, on_output)
+            else:
+                stdout, stderr = await proc.communicate(intxt.encode('utf-8'))
+        except BaseException:
+            # cancelled because another corpus failed, or this one did
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        finally:
+            watcher.cancel()
+        THE_METRICS.observe('regtest_step_seconds', time.time() - start, step=name)
+        if peak[0]:
+            THE_METRICS.observe('regtest_step_peak_rss_bytes', peak[0],
+                                buckets=Metrics.size_buckets, step=name)
+            if corpus and not self.sample:
+                steps = self.memory.setdefault(corpus.name, {})
+                steps[name] = max(steps.get(name, 0), peak[0])
+        if limit and proc.returncode != 0 and self.hit_limit(stderr, peak, limit):
+            c = cmd if isinstance(cmd, str) else ' '.join(cmd)
+            if not quiet:
+                print('Step %s of %s exceeded its memory limit of %s: %s' % (
+                    name, corpus.name, format_size(limit), c))
+                log_failure(c, intxt, outfile, stdout, stderr)
+                print('Exiting')
+            raise ResourceLimitExceeded(c, intxt, outfile, stdout, stderr)
+        return finish_command(cmd, intxt, outfile, proc.returncode,
+                              stdout, stderr, quiet=quiet, write=write)
+    async def watch_memory(self, pid, peak):
+        # the process may be reaped before we can ask, so poll
+        import asyncio
+        while True:
+            vals = read_peak_memory(pid)
+            if vals is None:
+                return
+            peak[0] = max(peak[0], vals[0])
+            peak[1] = max(peak[1], vals[1])
+            await asyncio.sleep(0.05)
+    def hit_limit(self, stderr, peak, limit):
+        # a failed allocation looks different in every program, so
+        # look for the usual signs; other crashes, even by a signal,
+        # are reported as crashes
+        if peak[1] >= 0.9 * limit:
+            return True
+        err = stderr.decode('utf-8', 'replace').lower()
+        return any(m in err for m in ['bad_alloc', 'cannot allocate memory',
+                                      'out of memory', 'memoryerror'])
+    async def stream(self, proc, intxt, on_output):
+        import asyncio
+        async def feed():
+            try:
+                proc.stdin.write(intxt.encode('utf-8'))
+                await proc.stdin.drain()
+                proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass # the process exited early, which proc.wait() reports
+        async def read_stdout():
+            blocks = []
+            while True:
+                block = await proc.stdout.read(1 << 16)
+                if not block:
+                    return b''.join(blocks)
+                blocks.append(block)
+                on_output(block)
+        res = await asyncio.gather(feed(), read_stdout(), proc.stderr.read())
+        await proc.wait()
+        return res[1], res[2]
+    def stages(self, corpus):
+        # [(step name, command, shell)] for the processes of a corpus
+        if not corpus.mode:
+            return [('all', corpus.shell, True)]
+        return [(step.name, step.command(), False) for step in
+                Mode.all_modes[corpus.mode].get_steps(corpus.start_step)]
+    async def run_lines(self, corpus, txt, write=True, live=True):
+        # returns the outputs of the steps which finished and the
+        # exception raised by the one which failed, if any
+        # with live=False, the final output isn't passed to LiveCheck
+        outs = {}
+        stages = self.stages(corpus)
+        for i, (name, cmd, shell) in enumerate(stages):
+            if not shell and cmd[0] == 'vislcg3':
+                txt = txt.replace('\0', '\n<STREAMCMD:FLUSH>\n')
+            on_output = None
+            if live and i == len(stages) - 1 and corpus.name in self.live:
+                on_output = self.live[corpus.name].feed
+            try:
+                out = await self.run_process(cmd, txt, self.out_name(corpus, name),
+                                             shell=shell, name=name,
+                                             quiet=(not write), write=write,
+                                             on_output=on_output,
+                                             corpus=corpus)
+            except ErrorInPipeline as e:
+                return outs, e
+            outs[name] = out
+            txt = out.decode('utf-8')
+        return outs, None
+    async def run_corpus(self, corpus):
+        # returns the lines which crashed
+        if not Corpus.flat:
+            ensure_dir_exists('output')
+        if Scheduler.chunk_size > 0 and corpus.infile:
+            return await self.run_chunked(corpus)
+        txt = ''
+        if corpus.infile:
+            txt = format_input(corpus.load_inputs(), self.lines(corpus))
+        outs, err = await self.run_lines(corpus, txt)
+        if err:
+            raise err
+        return []
+    async def run_chunked(self, corpus):
+        # lines which make the pipeline fail are found by bisecting the
+        # chunk and get an entry saying so in each step they didn't pass
+        inputs = corpus.load_inputs()
+        # lines which failed before go first, so they're reported early
+        hashes = THE_FAILURE_HISTORY.order(corpus.name, self.lines(corpus))
+        size = Scheduler.chunk_size
+        crashed = []
+        with ExitStack() as stack:
+            files = {name: stack.enter_context(replace_file(self.out_name(corpus, name), 'wb'))
+                     for name, cmd, shell in self.stages(corpus)}
+            for i in range(0, len(hashes), size):
+                chunk = hashes[i:i+size]
+                before = len(crashed)
+                await self.run_isolated(corpus, inputs, chunk, files, crashed)
+                if len(chunk) > 1 and len(crashed) - before == len(chunk):
+                    # every line failing means the pipeline is broken
+                    print('Every line of %s crashed, giving up' % corpus.name)
+                    raise ErrorInPipeline(crashed[-1][1])
+        if crashed:
+            print('%s of %s lines of %s crashed:' % (len(crashed), len(hashes), corpus.name))
+            for hsh, c in crashed:
+                print('  line %s (%s) in `%s`' % (inputs[hsh][0] + 1, hsh, c))
+        return [hsh for hsh, c in crashed]
+    async def run_isolated(self, corpus, inputs, hashes, files, crashed):
+        txt = format_input(inputs, hashes)
+        outs, err = await self.run_lines(corpus, txt, write=False, live=False)
+        if err and len(hashes) == 1:
+            # give it another chance before blaming the line
+            outs, err = await self.run_lines(corpus, txt, write=False,
+                                             live=False)
+        # only what is written is compared, not every attempt
+        live = self.live.get(corpus.name)
+        last = self.stages(corpus)[-1][0]
+        def keep(name, data):
+            files[name].write(data)
+            if live and name == last:
+                live.feed(data)
+        if not err:
+            for name, out in outs.items():
+                keep(name, out)
+            return
+        if len(hashes) > 1:
+            mid = len(hashes) // 2
+            await self.run_isolated(corpus, inputs, hashes[:mid], files, crashed)
+            await self.run_isolated(corpus, inputs, hashes[mid:], files, crashed)
+            return
+        hsh = hashes[0]
+        log_failure(*err.args)
+        crashed.append((hsh, err.args[0]))
+        what = 'CRASHED'
+        if isinstance(err, ResourceLimitExceeded):
+            what = 'MEMORY LIMIT EXCEEDED'
+        for name in files:
+            if name in outs:
+                keep(name, outs[name])
+            else:
+                keep(name, ('[%s#%s] %s: %s\n[/%s]\n\0' % (
+                    hsh, inputs[hsh][0], what, err.args[0], hsh)).encode('utf-8'))
+    async def take(self):
+        # the first pending corpus, in order, whose expected memory fits
+        # into what is left of the budget
+        async with self.available:
+            while self.pending:
+                for i, corpus in enumerate(self.pending):
+                    need = self.expected_memory(corpus)
+                    if (Scheduler.memory_budget is None or self.in_use == 0 or
+                            self.in_use + need <= Scheduler.memory_budget):
+                        self.pending.pop(i)
+                        self.in_use += need
+                        return corpus, need
+                await self.available.wait()
+            return None, 0
+    async def release(self, need):
+        async with self.available:
+            self.in_use -= need
+            self.available.notify_all()
+    async def worker(self):
+        # each corpus is a chain of steps, so one worker never has
+        # more than one process running
+        while True:
+            corpus, need = await self.take()
+            if corpus is None:
+                return
+            start = time.time()
+            try:
+                crashed = await self.run_corpus(corpus)
+            finally:
+                await self.release(need)
+            self.record_crashed(corpus, crashed)
+            if not self.sample:
+                self.durations[corpus.name] = time.time() - start
+            if not crashed and corpus.name in self.keys:
+                self.cache.store(self.keys[corpus.name], corpus)
+            if corpus.name in self.live:
+                corpus.live = self.live[corpus.name]
+                corpus.live.finish()
+            if self.progress:
+                self.progress.clear()
+            if self.on_done:
+                self.on_done(corpus)
+    async def run_all(self):
+        import asyncio
+        self.available = asyncio.Condition()
+        n = max(1, min(Scheduler.jobs, len(self.pending)))
+        await asyncio.gather(*[self.worker() for i in range(n)])
+    def run(self):
+        try:
+            if self.on_done:
+                for corpus in self.cached:
+                    self.on_done(corpus)
+            if self.pending:
+                # asyncio takes a while to import, so it is only
+                # imported once there are processes to run
+                import asyncio
+                asyncio.run(self.run_all())
+        finally:
+            if self.progress:
+                self.progress.clear()
+            save_state('durations.json', self.durations)
+            save_state('memory.json', self.memory)
+            if self.crashed:
+                save_crashed(self.crashed)
+
+class LiveCheck:
+    '''Compares the final step of a corpus with its expected output and
+    gold as the pipeline produces it.'''
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.step = corpus.command_list[-1]
+        self.inputs = corpus.load_inputs()
+        self.sort = self.step in corpus.sort
+        norm = corpus.normalizer(self.step)
+        self.normalize = corpus.normalizer(self.step, self.sort)
+        self.expect = load_output(corpus.exp_name(self.step), normalize=norm)
+        self.gold = gold_digests(load_gold(corpus.gold_name(self.step)), norm)
+        # like Corpus.load(), additions are relative to the first step
+        first = corpus.command_list[0]
+        if first == self.step:
+            self.known = set(self.expect.keys())
+        else:
+            self.known = set(output_keys(corpus.exp_name(first)))
+        self.total = sum(1 for h in self.inputs if h in self.known)
+        # the results are everything `test` needs if only the final
+        # step is relevant
+        self.complete = (corpus.relevant_commands == [self.step])
+        self.results = {} # { hash : (matches expected or gold, matches gold) }
+        self.passes = 0
+        self.buf = b''
+        self.empty = digest('')
+        self.progress = None
+    @staticmethod
+    def create(corpus):
+        # Corpus.load() creates the expected files which don't exist
+        # yet, for every step, so leave those corpora to it
+        for c in corpus.command_list:
+            if not output_exists(corpus.exp_name(c)):
+                return None
+        return LiveCheck(corpus)
+    @phase('comparison')
+    def feed(self, data):
+        # an entry can only be complete once its closing tag has arrived,
+        # so a long entry split over many chunks isn't rescanned for each
+        # one; closing tags are [/hash] and hashes are 12 characters
+        start = max(0, len(self.buf) - 16)
+        self.buf += data
+        if hash_close_bytes.search(self.buf, start):
+            self.scan()
+        if self.progress:
+            self.progress.update()
+    def scan(self):
+        end = 0
+        for m in hash_format_bytes.finditer(self.buf):
+            content = m.group(3).decode('utf-8').replace('\0', '').strip()
+            if self.sort:
+                content = sort_analyses(content)
+            if self.normalize:
+                content = self.normalize(content)
+            self.record(m.group(1).decode('utf-8'), digest(content))
+            end = m.end()
+        self.buf = self.buf[end:]
+    def record(self, hsh, out):
+        if hsh not in self.known or hsh not in self.inputs:
+            return
+        exp = self.expect.digest(hsh) if hsh in self.expect else self.empty
+        g = out in self.gold.get(hsh, ())
+        e = g or out == exp
+        if hsh in self.results:
+            self.passes -= self.results[hsh][0]
+        self.results[hsh] = (e, g)
+        self.passes += e
+    def finish(self):
+        self.scan()
+        # lines the pipeline dropped count as empty
+        for hsh in self.inputs:
+            if hsh in self.known and hsh not in self.results:
+                self.record(hsh, self.empty)
+        self.buf = b''
+    def summary(self):
+        # returns additions, deletions, tests, passes, and gold matches
+        add = [k for k in self.inputs if k not in self.known]
+        add.sort(key = lambda x: self.inputs[x][0])
+        delete = sorted(k for k in self.known if k not in self.inputs)
+        gold = sum(1 for e, g in self.results.values() if g)
+        return add, delete, len(self.results), self.passes, gold
+    def failures(self):
+        return [h for h, (e, g) in self.results.items() if not e]
+
+class Progress:
+    # one self-overwriting line on the terminal while corpora run
+    def __init__(self, checks):
+        self.checks = checks
+        self.total = sum(c.total for c in checks)
+        self.start = time.time()
+        self.last = 0
+        self.shown = False
+        self.enabled = sys.stdout.isatty() and self.total > 0
+        for c in checks:
+            c.progress = self
+    def update(self):
+        now = time.time()
+        if not self.enabled or now - self.last < 0.2:
+            return
+        self.last = now
+        done = sum(len(c.results) for c in self.checks)
+        passes = sum(c.passes for c in self.checks)
+        rate = done / max(now - self.start, 0.001)
+        line = '%s/%s sentences, %.1f/s, %.1f%% passing' % (
+            done, self.total, rate, 100.0 * passes / max(1, done))
+        if rate > 0:
+            line += ', ETA %ds' % ((self.total - done) / rate)
+        sys.stdout.write('\r' + line.ljust(70))
+        sys.stdout.flush()
+        self.shown = True
+    def clear(self):
+        if self.shown:
+            sys.stdout.write('\r' + ' ' * 70 + '\r')
+            sys.stdout.flush()
+            self.shown = False
+
+@phase('pipeline')
+def run_corpora(corpora, on_done=None, live=False, sample=None, outdir=None):
+    # if on_done raises an exception, unfinished corpora are abandoned
+    Scheduler(corpora, on_done, live, sample, outdir).run()
+
 def test_run(corpora):
     ls = corpora
     if '*' in corpora:
         ls = list(Corpus.all_corpora.keys())
-    for name in ls:
-        Corpus.all_corpora[name].run()
+    run_corpora([Corpus.all_corpora[name] for name in ls])
     return True, ''
 
-def cb_load(page, step=25):
-    changes = {
-        'changed_final': [],
-        'changed_any': [],
-        'unchanged': []
-    }
+class PageIndex:
+    # prefix sums of corpus lengths in sorted order, so that a page
+    # can be mapped to the corpora it overlaps without visiting the rest
+    def __init__(self):
+        self.names = []
+        self.offsets = [0]
+        self.history = None
+        self.stale = True
+    def refresh(self):
+        self.names = sorted(Corpus.all_corpora.keys())
+        self.offsets = [0]
+        for name in self.names:
+            self.offsets.append(self.offsets[-1] + len(Corpus.all_corpora[name]))
+        self.history = None
+        self.stale = False
+    def invalidate(self):
+        self.stale = True
+    def total(self):
+        if self.stale:
+            self.refresh()
+        return self.offsets[-1]
+    def locate(self, start, end):
+        # yield (name, start within corpus, length) for each corpus
+        # overlapping the range [start, end)
+        if self.stale:
+            self.refresh()
+        i = bisect.bisect_right(self.offsets, start) - 1
+        while i < len(self.names) and self.offsets[i] < end:
+            lo = max(start, self.offsets[i])
+            hi = min(end, self.offsets[i+1])
+            if hi > lo:
+                yield self.names[i], lo - self.offsets[i], hi - lo
+            i += 1
+    def locate_history(self, start, end):
+        # [(name, hashes)] for the range [start, end) of all lines of all
+        # corpora ordered as in FailureHistory.order(), so that the lines
+        # which failed most often come first across corpora and pages
+        if self.stale:
+            self.refresh()
+        if self.history is None:
+            lines = []
+            for name in self.names:
+                corpus = Corpus.all_corpora[name]
+                corpus.load_inputs()
+                for hsh in corpus.hashes:
+                    score = THE_FAILURE_HISTORY.score(name, hsh)
+                    lines.append((-score[0], -score[1], name, hsh))
+            # sort is stable, so ties stay in corpus and line order
+            lines.sort(key=lambda x: x[:2])
+            self.history = [(name, hsh) for _, _, name, hsh in lines]
+        ret = []
+        for name, hsh in self.history[start:end]:
+            if not ret or ret[-1][0] != name:
+                ret.append((name, []))
+            ret[-1][1].append(hsh)
+        return ret
+
+THE_PAGE_INDEX = PageIndex()
+
+def cb_load(page, step=25, order=None):
     state = {
         '_step': step,
         '_ordered': [],
         '_page': page
     }
-    ct_min = page * step
-    ct_max = (page + 1) * step
-    ct = 0
-    for name in sorted(Corpus.all_corpora.keys()):
+    ct = THE_PAGE_INDEX.total()
+    if order == 'history':
+        runs = THE_PAGE_INDEX.locate_history(page * step, (page + 1) * step)
+        state['_ordered'] = [[name, hsh] for name, hs in runs for hsh in hs]
+        spans = {}
+        for name, hs in runs:
+            spans.setdefault(name, []).extend(hs)
+    else:
+        spans = {name: (start, ln) for name, start, ln in
+                 THE_PAGE_INDEX.locate(page * step, (page + 1) * step)}
+    load_in_parallel([Corpus.all_corpora[name] for name in spans])
+    for name, span in spans.items():
         corpus = Corpus.all_corpora[name]
         corpus.load()
-        ct_next = ct + len(corpus)
-        if ct_next < ct_min or ct >= ct_max:
-            state[name] = corpus.page(0, 0)
-        elif ct < ct_min:
-            start = ct_min - ct
-            ln = min(ct_max, ct_next) - ct_min
-            state[name] = corpus.page(start, ln)
-        else: # ct >= ct_min
-            ln = min(ct_max, ct_next) - ct
-            state[name] = corpus.page(0, ln)
-        ct = ct_next
+        if order == 'history':
+            state[name] = corpus.page(0, 0, span)
+        else:
+            state[name] = corpus.page(*span)
+    for name in THE_PAGE_INDEX.names:
+        if name not in state:
+            state[name] = Corpus.all_corpora[name].summary()
     state['_count'] = ct
     state['_pages'] = math.ceil(ct/step)
     return {'state': state}
@@ -710,36 +2721,24 @@ def compress(s):
 
 THE_CALLBACK_LOCK = threading.Lock()
 
-class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
-    protocol_version = 'HTTP/1.1'
-
-    def __init__(self, request, client_address, server, directory=None,
-                 page_size=25):
-        self.page_size = page_size
-        super().__init__(request, client_address, server, directory=directory)
-
-    def do_GET(self):
-        parts = urllib.parse.urlsplit(self.path)
-        if parts.path.strip('/') != 'callback':
-            return super().do_GET()
-        else:
-            params = urllib.parse.parse_qs(parts.query)
-            self.do_callback(params)
-
-    def do_POST(self):
-        ln = int(self.headers['Content-Length'])
-        data = self.rfile.read(ln)
-        self.do_callback(urllib.parse.parse_qs(data.decode('utf-8')))
-
+class JSONResponseMixin:
+    @phase('serialization')
     def send_json(self, status, blob):
         # based on https://github.com/PierreQuentel/httpcompressionserver/blob/master/httpcompressionserver.py (BSD license)
         self.send_response(status)
         self.send_header('Content-type', 'application/json')
+        start = time.time()
         rstr = json.dumps(blob).encode('utf-8')
+        THE_METRICS.observe('regtest_json_serialize_seconds', time.time() - start)
+        THE_METRICS.observe('regtest_response_bytes', len(rstr),
+                            buckets=Metrics.size_buckets,
+                            action=getattr(self, 'action', ''))
         self.send_header('Content-Encoding', 'deflate')
+        start = time.time()
         if len(rstr) < (2 << 18):
             # don't bother chunking shorter messages
             dt = b''.join(compress(rstr))
+            THE_METRICS.observe('regtest_json_compress_seconds', time.time() - start)
             self.send_header('Content-Length', len(dt))
             self.end_headers()
             self.wfile.write(dt)
@@ -751,6 +2750,40 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
                     ln = hex(len(data))[2:].upper().encode('utf-8')
                     self.wfile.write(ln + b'\r\n' + data + b'\r\n')
             self.wfile.write(b'0\r\n\r\n')
+            # includes writing to the socket
+            THE_METRICS.observe('regtest_json_compress_seconds', time.time() - start)
+
+class CallbackRequestHandler(JSONResponseMixin):
+    # served as a http.server.SimpleHTTPRequestHandler, see make_server()
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, request, client_address, server, directory=None,
+                 page_size=25):
+        self.page_size = page_size
+        super().__init__(request, client_address, server, directory=directory)
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path.strip('/') == 'metrics':
+            self.send_metrics()
+        elif parts.path.strip('/') != 'callback':
+            return super().do_GET()
+        else:
+            params = urllib.parse.parse_qs(parts.query)
+            self.do_callback(params)
+
+    def send_metrics(self):
+        resp = THE_METRICS.render().encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', len(resp))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def do_POST(self):
+        ln = int(self.headers['Content-Length'])
+        data = self.rfile.read(ln)
+        self.do_callback(urllib.parse.parse_qs(data.decode('utf-8')))
 
     def do_callback(self, params):
         if 'a' not in params:
@@ -765,82 +2798,291 @@ class CallbackRequestHandler(http.server.SimpleHTTPRequestHandler):
         status = HTTPStatus.OK
         resp = {}
         shutdown = False
+        self.action = params['a'][0]
+        start = time.time()
 
         THE_CALLBACK_LOCK.acquire()
+        THE_METRICS.observe('regtest_lock_wait_seconds', time.time() - start)
+        if THE_PROFILER:
+            THE_PROFILER.enable_thread()
+        try:
+            # TODO: error checking
+            if params['a'][0] == 'init':
+                resp['folder'] = os.path.basename(os.getcwd())
+                resp['corpora'] = list(sorted(Corpus.all_corpora.keys()))
+            elif params['a'][0] == 'load':
+                try:
+                    resp = cb_load(int(params['p'][0]), self.page_size,
+                                   params.get('o', [None])[0])
+                except InputFileDoesNotExist as e:
+                    resp = {'error': 'Input file %s expected but not found! Server exiting.' % e.args[0]}
+                    shutdown = True
+                except InputFileIsEmpty as e:
+                    resp = {'error': 'Input file %s contained no data! Server exiting.' % e.args[0]}
+                    shutdown = True
+            elif params['a'][0] == 'run':
+                try:
+                    good, output = test_run(params.get('c', ['*']))
+                    THE_PAGE_INDEX.invalidate()
+                    resp['good'] = good
+                    resp['output'] = output
+                except ResourceLimitExceeded as e:
+                    resp = {'error': 'Command `%s` exceeded its memory limit. Server exiting.' % e.args[0]}
+                    shutdown = True
+                except ErrorInPipeline as e:
+                    resp = {'error': 'Command `%s` crashed. Server exiting.' % e.args[0]}
+                    shutdown = True
+            elif params['a'][0] == 'accept-nd':
+                resp['c'] = params['c'][0]
+                try:
+                    corpus = Corpus.all_corpora[resp['c']]
+                    # the corpus may not be on the current page
+                    corpus.load()
+                    resp['hs'] = corpus.accept_add_del()
+                    THE_PAGE_INDEX.invalidate()
+                except KeyError:
+                    resp = {'error': "Must run regression tests for corpus '%s' before accepting additions (with `make test` or the button at the top of the page)." % params['c'][0]}
+                    status = HTTPStatus.PRECONDITION_FAILED
+            elif params['a'][0] == 'accept':
+                resp['c'] = params['c'][0]
+                s = params.get('s', [None])[0]
+                hs = []
+                if 'hs' in params:
+                    hs = params['hs'][0].split(';')
+                resp['hs'] = Corpus.all_corpora[resp['c']].accept(hs, s)
+            elif params['a'][0] == 'accept-step':
+                corpus = Corpus.all_corpora.get(params.get('c', [None])[0])
+                step = params.get('f', [None])[0]
+                last = params.get('s', [None])[0]
+                if (corpus is None or step not in corpus.commands or
+                    (last is not None and last not in corpus.commands)):
+                    resp = {'error': 'accept-step needs a corpus c, a step f, and optionally a step s'}
+                    status = HTTPStatus.BAD_REQUEST
+                else:
+                    corpus.load()
+                    resp['c'] = corpus.name
+                    resp['hs'] = corpus.accept_step(step, last)
+            elif params['a'][0] == 'gold':
+                corp = params['c'][0]
+                hsh = params['h'][0]
+                golds = json.loads(params['gs'][0])
+                stp = None
+                if 's' in params:
+                    stp = params['s'][0]
+                Corpus.all_corpora[corp].set_gold(hsh, golds, stp)
+                resp = {'c': corp, 'hs': [hsh]}
+            elif params['a'][0] == 'diff':
+                corp = params.get('c', [None])[0]
+                hsh = params.get('h', [None])[0]
+                stp = params.get('s', [None])[0]
+                corpus = Corpus.all_corpora.get(corp)
+                if (corpus is None or hsh is None or
+                    (stp is not None and stp not in corpus.commands)):
+                    resp = {'error': 'diff needs a corpus c, a hash h, and optionally a step s'}
+                    status = HTTPStatus.BAD_REQUEST
+                else:
+                    # None if the line has no output or expected output
+                    resp = {'c': corp, 'h': hsh, 's': stp,
+                            'diff': corpus.diff_line(hsh, stp)}
+            else:
+                resp['error'] = 'unknown value for parameter a'
 
-        # TODO: error checking
-        if params['a'][0] == 'init':
-            resp['folder'] = os.path.basename(os.getcwd())
-            resp['corpora'] = list(sorted(Corpus.all_corpora.keys()))
-        elif params['a'][0] == 'load':
-            try:
-                resp = cb_load(int(params['p'][0]), self.page_size)
-            except InputFileDoesNotExist as e:
-                resp = {'error': 'Input file %s expected but not found! Server exiting.' % e.args[0]}
-                shutdown = True
-            except InputFileIsEmpty as e:
-                resp = {'error': 'Input file %s contained no data! Server exiting.' % e.args[0]}
-                shutdown = True
-        elif params['a'][0] == 'run':
-            try:
-                good, output = test_run(params.get('c', ['*']))
-                resp['good'] = good
-                resp['output'] = output
-            except ErrorInPipeline as e:
-                resp = {'error': 'Command `%s` crashed. Server exiting.' % e.args[0]}
-                shutdown = True
-        elif params['a'][0] == 'accept-nd':
-            resp['c'] = params['c'][0]
-            try:
-                resp['hs'] = Corpus.all_corpora[resp['c']].accept_add_del()
-            except KeyError:
-                resp = {'error': "Must run regression tests for corpus '%s' before accepting additions (with `make test` or the button at the top of the page)." % params['c'][0]}
-                status = HTTPStatus.PRECONDITION_FAILED
-        elif params['a'][0] == 'accept':
-            resp['c'] = params['c'][0]
-            s = params.get('s', [None])[0]
-            hs = []
-            if 'hs' in params:
-                hs = params['hs'][0].split(';')
-            resp['hs'] = Corpus.all_corpora[resp['c']].accept(hs, s)
-        elif params['a'][0] == 'gold':
-            corp = params['c'][0]
-            hsh = params['h'][0]
-            golds = json.loads(params['gs'][0])
-            stp = None
-            if 's' in params:
-                stp = params['s'][0]
-            Corpus.all_corpora[corp].set_gold(hsh, golds, stp)
-            resp = {'c': corp, 'hs': [hsh]}
-        else:
-            resp['error'] = 'unknown value for parameter a'
-
-        self.send_json(status, resp)
-        THE_CALLBACK_LOCK.release()
+            self.send_json(status, resp)
+        finally:
+            # a request which fails must not leave the server locked
+            if THE_PROFILER:
+                THE_PROFILER.disable_thread()
+            THE_CALLBACK_LOCK.release()
+        THE_METRICS.inc('regtest_requests_total', action=self.action)
+        THE_METRICS.observe('regtest_request_seconds', time.time() - start,
+                            action=self.action)
         if shutdown:
             if 'error' in resp:
                 sys.exit(1)
             else:
                 sys.exit(0)
 
-class BigQueueServer(socketserver.ThreadingTCPServer):
-    request_queue_size = 100
+def make_server(port, handler, base, **kwargs):
+    # http.server is slow to import and only needed by the server modes,
+    # so the handlers are only combined with its classes here
+    import http.server
+    import socketserver
+    class BigQueueServer(socketserver.ThreadingTCPServer):
+        request_queue_size = 100
+    cls = type(handler.__name__, (handler, getattr(http.server, base)), {})
+    return BigQueueServer(('', port), partial(cls, **kwargs))
 
 def start_server(port, page_size=25):
     d = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'static/')
     ensure_javascript(d)
-    handle = partial(CallbackRequestHandler, directory=d, page_size=page_size)
     print('Starting server')
     print('Open http://localhost:%d in your browser' % port)
-    with BigQueueServer(('', port), handle) as httpd:
+    with make_server(port, CallbackRequestHandler,
+                     'SimpleHTTPRequestHandler',
+                     directory=d, page_size=page_size) as httpd:
         try:
    	        httpd.serve_forever()
         except KeyboardInterrupt:
             print('')
+            if THE_PROFILER:
+                THE_PROFILER.finish()
             # the exception raised by sys.exit() gets caught by the
             # server, so we need to be a bit more drastic
             os._exit(0)
 
+class WorkerRequestHandler(JSONResponseMixin):
+    # served as a http.server.BaseHTTPRequestHandler, see make_server()
+    # POST /run {"corpus": name, "input": Corpus.input_digest(),
+    #            "hashes": [...] or null}
+    # => {"outputs": {step: text}} or {"error": message}
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path.strip('/') != 'run':
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': 'unknown path'})
+            return
+        ln = int(self.headers['Content-Length'])
+        job = json.loads(self.rfile.read(ln).decode('utf-8'))
+        name = job.get('corpus')
+        hashes = job.get('hashes')
+        if name not in Corpus.all_corpora:
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': 'Unknown corpus %s' % name})
+            return
+        corpus = Corpus.all_corpora[name]
+        print('Running %s (%s lines)' % (name, len(hashes) if hashes is not None else 'all'))
+        try:
+            if job.get('input') != corpus.input_digest():
+                self.send_json(HTTPStatus.CONFLICT, {'error': 'Input of corpus %s differs on worker' % name})
+                return
+            with tempfile.TemporaryDirectory() as outdir:
+                outputs = {}
+                for c, fname in corpus.run_shard(hashes, outdir).items():
+                    with open(fname, 'r') as fin:
+                        outputs[c] = fin.read()
+            self.send_json(HTTPStatus.OK, {'outputs': outputs})
+        except (InputFileDoesNotExist, InputFileIsEmpty) as e:
+            self.send_json(HTTPStatus.OK, {'error': 'Input file %s missing or empty on worker' % e.args[0]})
+        except ErrorInPipeline as e:
+            self.send_json(HTTPStatus.OK, {'error': 'Command `%s` crashed on worker' % e.args[0]})
+
+def start_worker(port):
+    print('Starting worker on port %d' % port)
+    with make_server(port, WorkerRequestHandler,
+                     'BaseHTTPRequestHandler') as httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print('')
+            os._exit(0)
+
+# seconds to wait for a worker to answer, which it only does once the
+# whole job has run
+WORKER_TIMEOUT = 3600
+
+def request_run(worker, name, digest, hashes):
+    # raises an exception if the worker can't be reached or its answer
+    # isn't one a worker would give
+    import urllib.request
+    url = worker.rstrip('/')
+    if '://' not in url:
+        url = 'http://' + url
+    body = json.dumps({'corpus': name, 'input': digest,
+                       'hashes': hashes}).encode('utf-8')
+    req = urllib.request.Request(url + '/run', data=body,
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=WORKER_TIMEOUT) as response:
+            data = response.read()
+    except urllib.error.HTTPError as e:
+        data = e.read()
+    if data[:1] != b'{':
+        data = zlib.decompress(data)
+    ret = json.loads(data.decode('utf-8'))
+    if not isinstance(ret, dict) or ('error' not in ret and
+                                     not isinstance(ret.get('outputs'), dict)):
+        raise ValueError('unexpected response from %s' % worker)
+    return ret
+
+def distributed_run(corpora, workers, shard_size=0):
+    '''Run corpora on remote workers (see `apertium-regtest worker`),
+    optionally split into shards of shard_size lines, and write the
+    combined outputs to the usual output files.'''
+    jobs = queue.Queue()
+    results = defaultdict(dict) # { corpus : { shard : { step : text } } }
+    shards = {}
+    digests = {}
+    errors = []
+    for corpus in corpora:
+        digests[corpus.name] = corpus.input_digest()
+        if shard_size > 0:
+            corpus.load_inputs()
+            hs = THE_FAILURE_HISTORY.order(corpus.name, corpus.hashes)
+            pieces = [hs[i:i+shard_size] for i in range(0, len(hs), shard_size)]
+        else:
+            pieces = [None]
+        shards[corpus.name] = len(pieces)
+        for i, hashes in enumerate(pieces):
+            jobs.put((corpus.name, i, hashes))
+    alive = [len(workers)]
+    remaining = [jobs.qsize()]
+    lock = threading.Lock()
+    def work(worker):
+        while not errors:
+            with lock:
+                if remaining[0] == 0:
+                    return
+            try:
+                name, i, hashes = jobs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                resp = request_run(worker, name, digests[name], hashes)
+            except Exception as e:
+                # unreachable or broken worker: give the job to someone
+                # else, since otherwise nobody would ever finish it
+                jobs.put((name, i, hashes))
+                with lock:
+                    print('Worker %s failed: %s' % (worker, e))
+                    alive[0] -= 1
+                    if alive[0] == 0:
+                        errors.append('No workers left')
+                return
+            if 'error' in resp:
+                errors.append(resp['error'])
+                return
+            with lock:
+                results[name][i] = resp['outputs']
+                remaining[0] -= 1
+                # under the lock, so that lines from several threads
+                # don't run into each other
+                print('Finished %s shard %s of %s on %s' % (name, i+1, shards[name], worker))
+    threads = [threading.Thread(target=work, args=(w,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        print('ERROR: ' + errors[0])
+        raise ErrorInPipeline(errors[0])
+    for corpus in corpora:
+        if not Corpus.flat:
+            ensure_dir_exists('output')
+        for c in corpus.command_list:
+            pieces = [results[corpus.name][i].get(c)
+                      for i in range(shards[corpus.name])]
+            if any(p is None for p in pieces):
+                # step not run, e.g. before start-step
+                continue
+            with open(corpus.out_name(c), 'w') as fout:
+                for p in pieces:
+                    fout.write(p)
+        corpus.loaded = False
+        corpus.inputs = None
+        # workers run whole pipelines, which fail rather than crash lines
+        corpus.crashed = []
+    save_crashed({corpus.name: [] for corpus in corpora})
+
 class RegtestShell(cmd.Cmd):
     prompt = '> '
     lines_todo = defaultdict(list) # { corpus_name : [ hash, hash, ... ] }
@@ -850,15 +3092,20 @@ class RegtestShell(cmd.Cmd):
     current_hash = None
     end_step = None
     show_step = None
+    step_filter = None
+    order = 'line' # or 'history' or 'step'
+    default_order = {} # { corpus_name : { hash : position } }
     def __init__(self):
         print('\nRunning regression tests for %s' % os.path.basename(os.getcwd()))
         print('Type `help` for a list of available commands.\n')
-        print('Loading corpora...')
-        for k in sorted(Corpus.all_corpora.keys()):
-            self.load_corpus(k)
+        # corpora are only parsed once we need to display them
+        self.unloaded = sorted(Corpus.all_corpora.keys())
+        print('Found %s corpora.' % len(self.unloaded))
         self.next_hash()
         super().__init__()
     def load_corpus(self, name):
+        if name in self.unloaded:
+            self.unloaded.remove(name)
         corp = Corpus.all_corpora[name]
         corp.load()
         self.lines_todo[name] = []
@@ -871,8 +3118,25 @@ class RegtestShell(cmd.Cmd):
             else:
                 self.lines_todo[name] = corp.data['add'] + corp.data['del']
         self.lines_todo[name] += corp.get_changed_hashes()
+        self.default_order[name] = {h: i for i, h in enumerate(self.lines_todo[name])}
+        self.apply_order(name)
         # TODO: important hashes in all corpora before unimporant ones
         print('Corpus %s has %s lines to be examined.' % (name, len(self.lines_todo[name])))
+    def apply_order(self, name):
+        todo = self.lines_todo[name]
+        todo.sort(key=lambda h: self.default_order[name].get(h, 0))
+        if self.order == 'history':
+            self.lines_todo[name] = THE_FAILURE_HISTORY.order(name, todo)
+        elif self.order == 'step':
+            corp = Corpus.all_corpora[name]
+            todo.sort(key=lambda h: corp.commands.get(corp.first_change(h), -1))
+    def todo(self, name):
+        # the lines of a corpus still to be examined which pass the filter
+        hs = self.lines_todo.get(name, [])
+        if not hs or not self.step_filter:
+            return hs
+        corp = Corpus.all_corpora[name]
+        return [h for h in hs if corp.first_change(h) == self.step_filter]
     def next_hash(self, drop_prev=False):
         if drop_prev and self.current_corpus in self.lines_todo:
             if self.current_hash in self.lines_todo[self.current_corpus]:
@@ -887,12 +3151,20 @@ class RegtestShell(cmd.Cmd):
             del self.lines_todo[k]
         if self.corpus_filter:
             self.current_corpus = self.corpus_filter
-        elif not self.current_corpus and len(self.lines_todo) > 0:
-            self.current_corpus = list(sorted(self.lines_todo.keys()))[0]
-        if self.current_corpus not in self.lines_todo:
+            if self.corpus_filter in self.unloaded:
+                self.load_corpus(self.corpus_filter)
+        elif not self.todo(self.current_corpus):
+            while self.unloaded and not any(self.todo(k) for k in self.lines_todo):
+                self.load_corpus(self.unloaded[0])
+            self.current_corpus = None
+            for k in sorted(self.lines_todo.keys()):
+                if self.todo(k):
+                    self.current_corpus = k
+                    break
+        if not self.todo(self.current_corpus):
             self.current_hash = None
         else:
-            self.current_hash = self.lines_todo[self.current_corpus][0]
+            self.current_hash = self.todo(self.current_corpus)[0]
             self.do_show('')
     def do_s(self, arg):
         'Synonym for `show`'
@@ -909,7 +3181,7 @@ the default display step.'''
             if arg:
                 self.show_step = arg
             corp.display_line(self.current_hash, self.show_step)
-        elif self.corpus_filter and len(self.lines_todo) > 0:
+        elif (self.corpus_filter or self.step_filter) and len(self.lines_todo) > 0:
             print('No changed lines match current filter')
             print("Use 'filter' to change filter or 'quit' to exit")
         else:
@@ -981,19 +3253,21 @@ Abbreviated form: `rg`'''
 `run`         - Run tests for all corpora.
 `run [name]`  - Run tests only for corpus `name`.
 Abbreviated form: `r`'''
+        names = []
         if corpus == '*' or corpus == '':
-            for name, corp in Corpus.all_corpora.items():
-                print('Running %s' % name)
-                corp.run()
-                self.load_corpus(name)
+            names = list(Corpus.all_corpora.keys())
         else:
             for name in corpus.split():
                 if name in Corpus.all_corpora:
-                    print('Running %s' % name)
-                    Corpus.all_corpora[name].run()
-                    self.load_corpus(name)
+                    names.append(name)
                 else:
                     print("Corpus '%s' does not exist" % name)
+        if names:
+            print('Running %s' % ', '.join(names))
+            run_corpora([Corpus.all_corpora[name] for name in names])
+            load_in_parallel([Corpus.all_corpora[name] for name in names])
+            for name in names:
+                self.load_corpus(name)
         self.next_hash()
     def complete_run(self, text, line, begidx, endidx):
         ls = []
@@ -1001,6 +3275,63 @@ Abbreviated form: `r`'''
             if c.startswith(text):
                 ls.append(c)
         return ls
+    def do_order(self, arg):
+        '''Choose the order in which lines are shown.
+`order line`    - Show lines in the order of the input file (default).
+`order history` - Show lines that have failed most often first.
+`order step`    - Group lines by the first step in which they changed.'''
+        if arg.strip() not in ['line', 'history', 'step']:
+            print('Order must be `line`, `history` or `step`')
+            return
+        RegtestShell.order = arg.strip()
+        for name in self.lines_todo:
+            self.apply_order(name)
+        self.next_hash()
+    def complete_order(self, text, line, begidx, endidx):
+        return [o for o in ['line', 'history', 'step'] if o.startswith(text)]
+    def do_steps(self, arg):
+        '''Count the lines to be examined by the first step in which they changed.'''
+        for name in sorted(self.lines_todo):
+            corp = Corpus.all_corpora[name]
+            groups = corp.changes_by_step(self.lines_todo[name])
+            print('%s:' % name)
+            for c in corp.command_list:
+                if c in groups:
+                    print('  %s: %s' % (c, len(groups[c])))
+        if self.unloaded:
+            print('%s corpora not loaded yet' % len(self.unloaded))
+    def do_from(self, arg):
+        '''Only show lines which first changed in a particular step.
+`from step` - Only show lines whose first changed step is `step`.
+`from`      - Show all lines again.'''
+        self.step_filter = arg.strip() or None
+        self.next_hash()
+    def complete_from(self, *args):
+        return self.complete_show(*args)
+    def do_acceptfrom(self, arg):
+        '''Accept every line which first changed in a particular step.
+`acceptfrom step` - Accept the lines whose first changed step is `step`
+                    in all corpora loaded so far.
+`acceptfrom`      - Use the step given to `from`.
+If `upto` has been called, this will not affect steps after the limit.'''
+        step = arg.strip() or self.step_filter
+        if not step:
+            print('No step given')
+            return
+        count = 0
+        for name in list(self.lines_todo):
+            corp = Corpus.all_corpora[name]
+            hs = set(corp.changes_by_step(self.lines_todo[name]).get(step, []))
+            if hs:
+                # with `upto`, lines may have nothing to accept
+                done = hs.intersection(corp.accept(list(hs), self.end_step))
+                self.lines_todo[name] = [h for h in self.lines_todo[name]
+                                         if h not in done]
+                count += len(done)
+        print('Accepted %s lines' % count)
+        self.next_hash()
+    def complete_acceptfrom(self, *args):
+        return self.complete_show(*args)
     def do_upto(self, arg):
         '''Disregard changes after a particular step.
 When `accept` is run, no steps after the last value passed to `upto`
@@ -1029,15 +3360,19 @@ Abbreviated form: `q`'''
         print('')
         return self.do_quit('')
 
+@phase('comparison')
 def check_hash(corpus, hsh):
+    return check_steps([corpus.step(c) for c in corpus.relevant_commands], hsh)
+
+def check_steps(steps, hsh):
     expect = True # matches expectation or gold in all cases
     gold = True   # matches gold in all cases
                   # note: if gold not present, returns False
-    for c in corpus.relevant_commands:
-        data = corpus.step(c)
-        out = data['output'].get(hsh, [0, ''])[1]
-        exp = data['expect'].get(hsh, [0, ''])[1]
-        gld = data['gold'].get(hsh, [])
+    empty = digest('')
+    for data in steps:
+        out = data['output'].digest(hsh) if hsh in data['output'] else empty
+        exp = data['expect'].digest(hsh) if hsh in data['expect'] else empty
+        gld = data['gold_digests'].get(hsh, ())
         if out in gld:
             continue
         else:
@@ -1046,47 +3381,129 @@ def check_hash(corpus, hsh):
                 expect = False
     return expect, gold
 
-def static_test(ignore_add=False, threshold=100, quiet=True):
+def count_tests(corp):
+    # the number of lines of a corpus which static_test() will count as
+    # tests: those with an expected output in the first step, or all of
+    # them if that is about to be created from their output
+    ins = corp.load_inputs()
+    expfile = corp.exp_name(corp.command_list[0])
+    if not output_exists(expfile):
+        return len(ins)
+    return sum(1 for hsh in output_keys(expfile) if hsh in ins)
+
+def static_test(ignore_add=False, threshold=100, quiet=True, run=True,
+                fail_fast=False):
     n = len(Corpus.all_corpora.items())
     changed = set()
     total_tests = 0
     total_passes = 0
-    for i, (name, corp) in enumerate(Corpus.all_corpora.items(), 1):
-        print('Corpus %s of %s: %s' % (i, n, name))
-        if not corp.loaded:
-            corp.run()
+    done = []
+    stopped = False
+    # with fail_fast, assume every line we haven't checked yet passes
+    # and give up once even that isn't enough
+    scored = {}
+    if fail_fast:
+        for name, corp in Corpus.all_corpora.items():
+            scored[name] = count_tests(corp)
+    unchecked = sum(scored.values())
+    # corpora can finish in any order, but are reported in the order of
+    # tests.json, each as soon as all the ones before it are
+    order = list(Corpus.all_corpora.keys())
+    reports = {}
+    printed = 0
+    def flush(upto):
+        nonlocal printed
+        while printed < upto:
+            name = order[printed]
+            printed += 1
+            if name not in reports:
+                continue
+            print('Corpus %s of %s: %s' % (printed, n, name))
+            for line in reports[name]:
+                print(line)
+    def check(corp):
+        nonlocal total_tests, total_passes, unchecked
+        name = corp.name
+        done.append(name)
+        out = reports[name] = []
+        if corp.live and corp.live.complete and not corp.loaded:
+            # already compared while the pipeline ran
+            add, delete, total, same, gold = corp.live.summary()
+            THE_FAILURE_HISTORY.record_output(corp, corp.live.step,
+                                              corp.live.failures())
+        else:
             corp.load()
-        if corp.data['add']:
-            print('  %s tests added since last run' % len(corp.data['add']))
+            corp.get_changed_hashes() # updates the failure history
+            add = corp.data['add']
+            delete = corp.data['del']
+            total = 0
+            same = 0
+            gold = 0
+            for hsh in corp.data['inputs']:
+                if hsh in add:
+                    continue
+                e, g = check_hash(corp, hsh)
+                total += 1
+                if e:
+                    same += 1
+                    if g:
+                        gold += 1
+        # crashed lines fail whether or not they were tests before
+        crashed = corp.crashed_lines() & set(add)
+        total += len(crashed)
+        if corp.crashed_lines():
+            out.append('  %s lines crashed' % len(corp.crashed_lines()))
+            changed.add(name)
+        if add:
+            out.append('  %s tests added since last run' % len(add))
             if not ignore_add:
                 changed.add(name)
-        if corp.data['del']:
-            print('  %s tests removed since last run' % len(corp.data['del']))
+        if delete:
+            out.append('  %s tests removed since last run' % len(delete))
             if not ignore_add:
                 changed.add(name)
-        total = 0
-        same = 0
-        gold = 0
-        for hsh in corp.data['inputs']:
-            if hsh in corp.data['add']:
-                continue
-            e, g = check_hash(corp, hsh)
-            total += 1
-            if e:
-                same += 1
-                if g:
-                    gold += 1
         total_tests += total
         total_passes += same
+        line = ''
         if total > 0:
-            print('  %s/%s (%s%%) tests pass' % (same, total, round(100.0*same/total, 2)), end='')
+            line = '  %s/%s (%s%%) tests pass' % (same, total, round(100.0*same/total, 2))
             if same != total:
                 changed.add(name)
         if same > 0:
-            print(' (%s/%s (%s%%) match gold)' % (gold, same, round(100.0*gold/same, 2)))
-        else:
-            print('')
+            line += ' (%s/%s (%s%%) match gold)' % (gold, same, round(100.0*gold/same, 2))
+        out.append(line)
+        out.append('')
+        while printed < n and order[printed] in reports:
+            flush(printed + 1)
+        if fail_fast:
+            unchecked = max(0, unchecked - scored[name])
+            best = 100.0 * (total_passes + unchecked) / max(1, total_tests + unchecked)
+            if best < threshold:
+                raise ThresholdUnreachable(best)
+    try:
+        if fail_fast:
+            # corpora which are already available first
+            for name, corp in Corpus.all_corpora.items():
+                if corp.loaded or not run:
+                    check(corp)
+        if run:
+            todo = [c for c in Corpus.all_corpora.values()
+                    if c.name not in done and not c.loaded]
+            run_corpora(todo, on_done=(check if fail_fast else None),
+                        live=True)
+        load_in_parallel([c for c in Corpus.all_corpora.values()
+                          if c.name not in done and
+                          not (c.live and c.live.complete)])
+        for name, corp in Corpus.all_corpora.items():
+            if name not in done:
+                check(corp)
+    except ThresholdUnreachable as e:
+        flush(n)
+        print('Stopping early: at most %s%% of tests can pass, which is below the threshold of %s%%.' % (round(e.args[0], 2), threshold))
+        print('Checked %s of %s corpora.' % (len(done), n))
         print('')
+        stopped = True
+    THE_FAILURE_HISTORY.save()
     if changed:
         if quiet:
             print('There were changes! Run `apertium-regtest cli` to update tests.')
@@ -1110,10 +3527,103 @@ def static_test(ignore_add=False, threshold=100, quiet=True):
             print('')
     else:
         print('All tests pass.')
+    if stopped:
+        return False
     return ((100.0 * total_passes) / total_tests) >= threshold
 
+def wilson_interval(k, n, z=1.96):
+    # 95% confidence interval for a proportion of k in n
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    d = 1 + z*z/n
+    mid = (p + z*z/(2*n)) / d
+    half = z * math.sqrt(p*(1-p)/n + z*z/(4*n*n)) / d
+    return max(0.0, mid - half), min(1.0, mid + half)
+
+def parse_sample(spec):
+    # '5%' => (0.05, None), '1000' => (None, 1000)
+    try:
+        if spec.endswith('%'):
+            frac = float(spec[:-1]) / 100
+            if 0 < frac <= 1:
+                return frac, None
+        elif int(spec) > 0:
+            return None, int(spec)
+    except ValueError:
+        pass
+    print('Invalid sample size %s, expected a percentage like 5%% or a number of lines' % spec)
+    sys.exit(1)
+
+def sample_test(spec, seed=0, threshold=100):
+    # run a random sample of the lines of each corpus, in proportion to
+    # its size, and estimate the overall pass rate
+    frac, count = parse_sample(spec)
+    rng = random.Random(seed)
+    candidates = {}
+    for name, corp in Corpus.all_corpora.items():
+        corp.load_inputs()
+        # only lines that already have an expected output are tests
+        known = set(output_keys(corp.exp_name(corp.command_list[0])))
+        candidates[name] = [h for h in corp.hashes if h in known]
+    population = sum(len(hs) for hs in candidates.values())
+    if population == 0:
+        print('No tests to sample.')
+        return False
+    if count is None:
+        count = max(1, round(frac * population))
+    count = min(count, population)
+    # each corpus gets the whole part of its share and the lines left
+    # over go to the largest remainders, so that exactly count lines
+    # are sampled
+    shares = {name: count * len(hs) / population
+              for name, hs in candidates.items()}
+    sizes = {name: int(share) for name, share in shares.items()}
+    left = count - sum(sizes.values())
+    for name in sorted(shares, key=lambda x: (sizes[x] - shares[x], x))[:left]:
+        sizes[name] += 1
+    sample = {}
+    for name, hs in sorted(candidates.items()):
+        if sizes[name] == 0:
+            continue
+        sample[name] = sorted(rng.sample(hs, sizes[name]),
+                              key=lambda h: Corpus.all_corpora[name].inputs[h][0])
+    n = len(sample)
+    total_tests = 0
+    total_passes = 0
+    with tempfile.TemporaryDirectory(prefix='regtest-sample-') as outdir:
+        corpora = [Corpus.all_corpora[name] for name in sample]
+        run_corpora(corpora, sample=sample, outdir=outdir)
+        for i, corp in enumerate(corpora, 1):
+            print('Corpus %s of %s: %s' % (i, n, corp.name))
+            steps = []
+            for c in corp.relevant_commands:
+                norm = corp.normalizer(c)
+                steps.append({
+                    'output': load_output(os.path.join(outdir, '%s-%s-output.txt' % (corp.name, c)),
+                                          should_sort_analyses=(c in corp.sort),
+                                          normalize=corp.normalizer(c, c in corp.sort)),
+                    'expect': load_output(corp.exp_name(c), normalize=norm),
+                    'gold_digests': gold_digests(load_gold(corp.gold_name(c)), norm)
+                })
+            hs = sample[corp.name]
+            same = sum(1 for h in hs if check_steps(steps, h)[0])
+            lo, hi = wilson_interval(same, len(hs))
+            print('  %s/%s (%s%%) sampled tests pass, from %s lines (95%% CI %s%%-%s%%)' % (
+                same, len(hs), round(100.0*same/len(hs), 2), len(candidates[corp.name]),
+                round(100*lo, 1), round(100*hi, 1)))
+            print('')
+            total_tests += len(hs)
+            total_passes += same
+    # the sample is proportional to corpus sizes, so it can be pooled
+    lo, hi = wilson_interval(total_passes, total_tests)
+    estimate = 100.0 * total_passes / total_tests
+    print('Estimated pass rate: %s%% (95%% CI %s%%-%s%%), from %s of %s tests with seed %s' % (
+        round(estimate, 2), round(100*lo, 1), round(100*hi, 1),
+        total_tests, population, seed))
+    return estimate >= threshold
+
 if __name__ == '__main__':
-    load_modes()
     import argparse
     parser = argparse.ArgumentParser(
         prog='apertium-regtest',
@@ -1126,14 +3636,34 @@ apertium-regtest has 3 modes available:
   - 'web'  starts a local webserver so that tests can be interactively
            updated from the browser.
   - 'cli'  interactively updates tests from the terminal.
+  - 'worker' waits for corpora to run on behalf of 'test --workers'.
+  - 'gc'   removes old entries from the result cache in AP_REGTEST_CACHE_DIR.
 ''')
-    parser.add_argument('mode', choices=['test', 'web', 'cli'])
+    parser.add_argument('mode', choices=['test', 'web', 'cli', 'worker', 'gc'])
 
     ### GENERAL ARGUMENTS
     parser.add_argument('-a', '--accept', action='store_true',
                         help="automatically accept additions and deletions")
     parser.add_argument('-c', '--corpus', action='append',
                         help="only load corpora matching a regular expression (this option can be provided multiple times)")
+    default_jobs = os.cpu_count() or 1
+    if os.environ.get('AP_REGTEST_JOBS', '').isnumeric():
+        default_jobs = int(os.environ['AP_REGTEST_JOBS'])
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help="maximum number of pipeline processes to run at once (default number of CPUs or AP_REGTEST_JOBS)")
+    default_chunk = 0
+    if os.environ.get('AP_REGTEST_CHUNK_SIZE', '').isnumeric():
+        default_chunk = int(os.environ['AP_REGTEST_CHUNK_SIZE'])
+    parser.add_argument('--chunk-size', type=int, default=default_chunk,
+                        help="run corpora this many lines at a time, so that lines which crash the pipeline are recorded instead of stopping the run (default off or AP_REGTEST_CHUNK_SIZE)")
+    parser.add_argument('-m', '--memory-budget',
+                        default=os.environ.get('AP_REGTEST_MEMORY', ''),
+                        help="only start corpora while the peak memory recorded for them on earlier runs adds up to less than this, e.g. 8G (default no limit or AP_REGTEST_MEMORY)")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the run, writing pstats data to --profile-file and printing a summary by phase")
+    parser.add_argument('--profile-file', default='regtest.prof',
+                        metavar='FILE',
+                        help="where --profile writes pstats data (default regtest.prof)")
 
     # TEST ARGUMENTS
     test_gp = parser.add_argument_group('test mode options')
@@ -1148,32 +3678,110 @@ apertium-regtest has 3 modes available:
     test_gp.add_argument('-q', '--quiet', action='store_true',
                          help="print minimal error message on test failure",
                          default=default_quiet)
+    default_workers = os.environ.get('AP_REGTEST_WORKERS', '')
+    test_gp.add_argument('-w', '--workers', default=default_workers,
+                         help="comma-separated host:port list of workers to run corpora on (default AP_REGTEST_WORKERS)")
+    test_gp.add_argument('-f', '--fail-fast', action='store_true',
+                         help="stop as soon as the --threshold can no longer be met")
+    test_gp.add_argument('-s', '--sample', metavar='SIZE',
+                         help="only run a random sample of each corpus, either a percentage (5%%) or a total number of lines, and estimate the pass rate")
+    test_gp.add_argument('--seed', type=int, default=0,
+                         help="random seed for --sample (default 0)")
+    test_gp.add_argument('--shard-size', type=int, default=0,
+                         help="with --workers, split corpora into shards of this many lines (default: whole corpora)")
+    test_gp.add_argument('--force', action='store_true',
+                         help="run the tests even if nothing has changed since the last run")
 
     # WEB ARGUMENTS
     web_gp = parser.add_argument_group('web mode options')
     web_gp.add_argument('-p', '--port', type=int, default=3000,
-                        help="in web mode, run the server on this port (default 3000)")
+                        help="in web or worker mode, run the server on this port (default 3000)")
     web_gp.add_argument('-z', '--pagesize', type=int, default=250,
                         help="size of blocks to send to browser in web mode (default 250)")
 
     # CLI ARGUMENTS
     cli_gp = parser.add_argument_group('cli mode options')
 
+    # GC ARGUMENTS
+    gc_gp = parser.add_argument_group('gc mode options')
+    gc_gp.add_argument('--max-age', type=float,
+                       help="remove cache entries unused for this many days")
+    gc_gp.add_argument('--max-size', type=float,
+                       help="remove least recently used cache entries until the cache is under this many megabytes")
+
     args = parser.parse_args()
+    if args.mode == 'gc':
+        cache = ResultCache.from_env()
+        if not cache:
+            print('AP_REGTEST_CACHE_DIR is not set.')
+            sys.exit(1)
+        cache.gc(max_age=(args.max_age * 86400 if args.max_age is not None else None),
+                 max_size=(args.max_size * (1 << 20) if args.max_size is not None else None))
+        sys.exit(0)
+    workers = [w for w in args.workers.split(',') if w.strip()]
+    manifest = None
+    if (args.mode == 'test' and os.path.isfile('test/tests.json') and
+        not (args.force or args.accept or args.sample or workers or
+             args.profile)):
+        manifest = Manifest({
+            'corpus': args.corpus,
+            'ignore_add': args.ignore_add,
+            'threshold': args.threshold,
+            'quiet': args.quiet,
+            'fail_fast': args.fail_fast,
+            'chunk_size': args.chunk_size
+        })
+        if manifest.fresh():
+            # stdout is the same as that of a real run, for scripts
+            # which read the report
+            print('Nothing has changed since the last run, so its report is repeated below.', file=sys.stderr)
+            print('Use --force to run the tests again.', file=sys.stderr)
+            print('', file=sys.stderr)
+            sys.stdout.write(manifest.last['report'])
+            sys.exit(manifest.last['status'])
+    if args.profile:
+        import atexit
+        THE_PROFILER = Profiler(args.profile_file)
+        THE_PROFILER.start()
+        atexit.register(THE_PROFILER.finish)
+    load_modes()
+    Scheduler.jobs = max(1, args.jobs)
+    Scheduler.chunk_size = args.chunk_size
+    if args.memory_budget:
+        try:
+            Scheduler.memory_budget = parse_size(args.memory_budget)
+        except ValueError:
+            print('Invalid memory budget %s' % args.memory_budget)
+            sys.exit(1)
     if args.accept:
         load_corpora(args.corpus, static=True)
-        for name, corp in Corpus.all_corpora.items():
-            try:
-                corp.run()
-                corp.load()
+        try:
+            run_corpora(list(Corpus.all_corpora.values()))
+            load_in_parallel(list(Corpus.all_corpora.values()))
+            for name, corp in Corpus.all_corpora.items():
                 corp.accept_add_del()
-            except (InputFileDoesNotExist, InputFileIsEmpty, ErrorInPipeline):
-                sys.exit(1)
+        except (InputFileDoesNotExist, InputFileIsEmpty, ErrorInPipeline):
+            sys.exit(1)
     if args.mode == 'test':
         load_corpora(args.corpus, static=True)
         try:
-            if not static_test(args.ignore_add, threshold=args.threshold,
-                               quiet=args.quiet):
+            if args.sample:
+                if not sample_test(args.sample, seed=args.seed,
+                                   threshold=args.threshold):
+                    sys.exit(1)
+                sys.exit(0)
+            if workers and not args.accept:
+                distributed_run(list(Corpus.all_corpora.values()), workers,
+                                args.shard_size)
+            if manifest:
+                manifest.record()
+            with (manifest.capture() if manifest else ExitStack()):
+                passed = static_test(args.ignore_add, threshold=args.threshold,
+                                     quiet=args.quiet, run=(not workers),
+                                     fail_fast=args.fail_fast)
+            if manifest:
+                manifest.save(0 if passed else 1)
+            if not passed:
                 sys.exit(1)
         except (InputFileDoesNotExist, InputFileIsEmpty, ErrorInPipeline):
             sys.exit(1)
@@ -1186,6 +3794,9 @@ apertium-regtest has 3 modes available:
             RegtestShell().cmdloop()
         except (InputFileDoesNotExist, InputFileIsEmpty, ErrorInPipeline):
             sys.exit(1)
+    elif args.mode == 'worker':
+        load_corpora(args.corpus, static=True)
+        start_worker(args.port)
     else:
-        print("Unknown operation mode. Expected 'test', 'web', or 'cli'.")
+        print("Unknown operation mode. Expected 'test', 'web', 'cli', 'worker', or 'gc'.")
         sys.exit(1)
@@ -2,6 +2,14 @@
 
 let state = {};
 let corpora = [];
+// Rendered diffs keyed by corpus/hash/step, reset on every page load
+let diff_cache = {};
+// Step selected with the tab buttons, applied to rows as they are rendered
+let selected_tab = null;
+// Show lines that failed most often in earlier runs first
+let order_history = false;
+// Only show lines which first changed in this step
+let first_filter = '*';
 
 function esc_html(t) {
 	return t.
@@ -163,151 +171,66 @@ function hilite_output(t, f) {
 	return t;
 }
 
-function tokenize_stream(s) {
-	let ret = [];
-	let cur = "";
-	let esc = false;
-	let word = false;
-	let blank = false;
-	let wblank = false;
-	for (let i = 0; i < s.length; i++) {
-		if (esc) {
-			esc = false;
-		} else if (s[i] == '\\') {
-			esc = true;
-		} else if (wblank) {
-			if (s[i] == ']' && i+1 < s.length && s[i+1] == ']') {
-				wblank = false;
-			}
-		} else if (blank) {
-			if (s[i] == ']') {
-				blank = false;
-			}
-		} else if (!word && s[i] == '[') {
-			blank = true;
-			if (i+1 < s.length && s[i+1] == '[') {
-				wblank = true;
-			}
-		} else if (!word && s[i] == '^' || s[i] == '}') {
-			word = true;
-			if (cur.length) {
-				ret.push(cur);
-				cur = "";
-			}
-		} else if (word && s[i] == '$' || s[i] == '{') {
-			cur += s[i];
-			ret.push(cur);
-			cur = "";
-			word = false;
-			continue;
-		}
-		cur += s[i];
-	}
-	if (cur.length) {
-		ret.push(cur);
-	}
-	return ret;
+function split_lus(t) {
+	// Split stream text into lexical units and the blanks between them
+	return t.split(/(\^(?:\\.|[^$\\])*\$)/).filter(x => x.length);
 }
 
-function tokenize_lu(s) {
-	let ret = [];
-	let cur = '';
-	let esc = false;
-	for (let i = 0; i < s.length; i++) {
-		if (esc) {
-		} else if (s[i] == '\\') {
-			esc = true;
-		} else if (s[i] == '/') {
-			ret.push(cur);
-			cur = '';
+function render_equal(t) {
+	let toks = split_lus(t);
+	let output = '';
+	let collapse = -1;
+	if (toks.length > 15) {
+		collapse = toks.length - 3;
+	}
+	for (let n = 0; n < toks.length; n++) {
+		if (toks[n][0] == '^') {
+			output += '<span class="c-ap-lu">';
 		}
-		cur += s[i];
-	}
-	ret.push(cur);
-	return ret;
-}
-
-function diff_lus(del_obj, add_obj) {
-	if (add_obj.removed) {
-		return diff_lus(add_obj, del_obj);
-	}
-	let del = del_obj.value;
-	let add = add_obj.value;
-	let out = '';
-	for (let i = 0; i < del.length; i++) {
-		if (del[i][0] == '^' && add[i][0] == '^') {
-			out += '<span class="c-ap-lu">';
-			let arr_d = tokenize_lu(del[i]);
-			let arr_a = tokenize_lu(add[i]);
-			let diff = Diff.diffArrays(arr_d, arr_a);
-			for (let d = 0; d < diff.length; d++) {
-				if (diff[d].added) {
-					out += '<ins>';
-					out += esc_html(diff[d].value.join(''));
-					out += '</ins>';
-				} else if (diff[d].removed) {
-					out += '<del>';
-					out += esc_html(diff[d].value.join(''));
-					out += '</del>';
-				} else {
-					for (let j = 0; j < diff[d].value.length; j++) {
-						out += hilite_output(diff[d].value[j], 'ap');
-					}
-				}
-			}
-			out += '</span>';
-		} else {
-			out += '<del>'+esc_html(del[i])+'</del>';
-			out += '<ins>'+esc_html(add[i])+'</ins>';
+		output += hilite_output(esc_html(toks[n]), 'ap');
+		if (toks[n][0] == '^') {
+			output += '</span>';
+		}
+		if (collapse != -1 && n == 2) {
+			output += '<div class="rt-expansion"><span class="rt-expanded">';
+		}
+		else if (n == collapse) {
+			output += '</span><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnExpand">…</button><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnCollapse">…</button></div>';
 		}
 	}
-	return out;
+	return output;
 }
 
-function diff_stream(exp, txt) {
-	let arr_e = tokenize_stream(exp);
-	let arr_t = tokenize_stream(txt);
-	let diff = Diff.diffArrays(arr_e, arr_t);
+function render_diff(ops) {
+	// Render the [op, text] pairs computed by the server's diff_outputs()
 	let output = '';
-	for (let n = 0; n < diff.length; n++) {
-		if (diff[n].added || diff[n].removed) {
-			if (n + 1 < diff.length && (diff[n+1].added || diff[n+1].removed)
-				&& diff[n+1].value.length == diff[n].value.length) {
-				output += diff_lus(diff[n], diff[n+1]);
-				n++;
-			} else {
-				output += (diff[n].added ? '<ins>' : '<del>');
-				for (let n2 = 0; n2 < diff[n].value.length; n2++) {
-					if (diff[n].value[n2][0] == '^') {
-						output += '<span class="c-ap-lu">';
-					}
-					output += esc_html(diff[n].value[n2]);
-					if (diff[n].value[n2][0] == '^') {
-						output += '</span>';
-					}
+	for (let n = 0; n < ops.length; n++) {
+		let op = ops[n][0];
+		let val = ops[n][1];
+		if (op == '~') {
+			output += '<span class="c-ap-lu">';
+			for (let i = 0; i < val.length; i++) {
+				if (val[i][0] == '=') {
+					output += hilite_output(esc_html(val[i][1]), 'ap');
+				} else {
+					let tag = (val[i][0] == '+' ? 'ins' : 'del');
+					output += '<'+tag+'>'+esc_html(val[i][1])+'</'+tag+'>';
 				}
-				output += (diff[n].added ? '</ins>' : '</del>');
 			}
+			output += '</span>';
+		} else if (op == '=') {
+			output += render_equal(val);
 		} else {
-			let collapse = -1;
-			if (diff[n].value.length > 15) {
-				collapse = diff[n].value.length - 3;
-			}
-			for (let n2 = 0; n2 < diff[n].value.length; n2++) {
-				if (diff[n].value[n2][0] == '^') {
-					output += '<span class="c-ap-lu">';
-				}
-				output += hilite_output(esc_html(diff[n].value[n2]), 'ap');
-				if (diff[n].value[n2][0] == '^') {
-					output += '</span>';
-				}
-				if (collapse != -1 && n2 == 2) {
-					output += '<div class="rt-expansion"><span class="rt-expanded">';
-				}
-				else if (n2 == collapse) {
-					output += '</span><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnExpand">…</button><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnCollapse">…</button></div>';
+			let tag = (op == '+' ? 'ins' : 'del');
+			output += '<'+tag+'>';
+			split_lus(val).forEach(function(t) {
+				if (t[0] == '^') {
+					output += '<span class="c-ap-lu">'+esc_html(t)+'</span>';
+				} else {
+					output += esc_html(t);
 				}
-			}
+			});
+			output += '</'+tag+'>';
 		}
 	}
 	return output;
@@ -333,7 +256,7 @@ function init() {
 
 function load(p) {
 	let tid = toast('Loading', 'Loading page '+(p+1)+'...');
-	post({a: 'load', p: p}).done(function(rv) { $(tid).toast('hide'); return cb_load(rv); });
+	post({a: 'load', p: p, o: order_history ? 'history' : 'line'}).done(function(rv) { $(tid).toast('hide'); return cb_load(rv); });
 }
 
 function toast(title, body, delay) {
@@ -384,9 +307,25 @@ function btn_filter_gold() {
 	$(this).addClass('active');
 }
 
+function btn_filter_first() {
+	first_filter = $(this).attr('data-which');
+	console.log('Filtering by first changed step '+first_filter);
+	if (first_filter === '*') {
+		$('.rt-filter-all').removeClass('rt-filter-step-hidden');
+		$('.btnAcceptFirst').hide();
+	} else {
+		$('.rt-filter-all').addClass('rt-filter-step-hidden');
+		$('.rt-first-'+first_filter).removeClass('rt-filter-step-hidden');
+		$('.btnAcceptFirst').show().text('Accept All First Changed In: '+first_filter);
+	}
+	apply_filters();
+	$('.btnFilterFirst').removeClass('active');
+	$(this).addClass('active');
+}
+
 function apply_filters() {
 	$('.rt-filter-all').hide();
-	$('.rt-filter-all').not('.rt-filter-unchanged-hidden').not('.rt-filter-gold-hidden').show();
+	$('.rt-filter-all').not('.rt-filter-unchanged-hidden').not('.rt-filter-gold-hidden').not('.rt-filter-step-hidden').show();
 	update_counts();
 	event_scroll();
 }
@@ -443,12 +382,19 @@ function btn_expand() {
 	div.find('.btnCollapse').show();
 }
 
+function active_output(tr) {
+	let c = tr.attr('data-corp');
+	let h = tr.attr('data-hash');
+	let i = tr.find('.rt-output.active').attr('data-cmd');
+	return state[c].cmds[i].output[h][1];
+}
+
 function btn_gold_replace() {
 	let tr = $(this).closest('tr');
 	let c = tr.attr('data-corp');
 	let h = tr.attr('data-hash');
 	let s = tr.find('.nav-link.active').text();
-	let gs = [tr.find('.rt-output.active').attr('data-output')];
+	let gs = [active_output(tr)];
 	let tid = toast('Replacing Gold', 'Corpus '+c+' sentence '+h+' step '+s);
 	post({a: 'gold', c: c, h: h, s: s, gs: JSON.stringify(gs)}).done(function(rv) { $(tid).toast('hide'); cb_accept(rv); });
 }
@@ -463,14 +409,14 @@ function btn_gold_add() {
 	if (gold.hasOwnProperty(h)) {
 		gs = gold[h];
 	}
-	gs.push(tr.find('.rt-output.active').attr('data-output'));
+	gs.push(active_output(tr));
 	let tid = toast('Adding Gold', 'Corpus '+c+' sentence '+h+' step '+s);
 	post({a: 'gold', c: c, h: h, s: s, gs: JSON.stringify(gs)}).done(function(rv) { $(tid).toast('hide'); cb_accept(rv); });
 }
 
 function btn_gold_manual() {
 	let tr = $(this).closest('tr');
-	let val = tr.find('.rt-output.active').attr('data-output');
+	let val = active_output(tr);
 	tr.find('.rt-gold-input').show().find('input').val(val);
 }
 
@@ -542,6 +488,19 @@ function btn_accept_all_until() {
 	});
 }
 
+function btn_accept_first() {
+	// Every line of the corpus, not just those on this page
+	let reqs = [];
+	corpora.forEach(function(c) {
+		if (state[c].summary || !state[c].steps[first_filter]) {
+			return;
+		}
+		let tid = toast('Accepting Step', 'Corpus '+c+', '+state[c].steps[first_filter]+' lines first changed in '+first_filter);
+		reqs.push(post({a: 'accept-step', c: c, f: first_filter}).done(function(rv) { $(tid).toast('hide'); }));
+	});
+	$.when.apply($, reqs).done(function() { load(state._page); });
+}
+
 function btn_accept_unchanged() {
 	$('.rt-changes').find('span.corp').filter(':visible').each(function() {
 		let hs = [];
@@ -558,6 +517,13 @@ function btn_accept_nd() {
 	post({a: 'accept-nd', c: c}).done(function(rv) { $(tid).toast('hide'); cb_accept_nd(rv); });
 }
 
+function btn_order_history() {
+	order_history = !order_history;
+	$('.btnOrderHistory').toggleClass('active', order_history);
+	// The server orders all lines of all corpora, so the pages change
+	load(0);
+}
+
 function btn_toggle_unchanged() {
 	let hidden = $('.rt-filter-unchanged-hidden');
 	if (hidden.length) {
@@ -631,57 +597,83 @@ function btn_show_tab() {
 		return;
 	}
 	let div = $($(this).attr('href'));
+	if (!div.attr('data-cmd')) {
+		// trace tab
+		$(this).attr('data-hilite', true);
+		return;
+	}
 
+	let c = row.attr('data-corp');
+	let h = row.attr('data-hash');
+	let cmd = state[c].cmds[div.attr('data-cmd')];
+	let key = c+'/'+h+'/'+cmd.opt;
 	let type = div.attr('data-type');
-	let text = div.attr('data-output');
-	let expect = div.attr('data-expect');
+	let text = cmd.output[h][1];
+	let expect = null;
+	if (cmd.changed.hasOwnProperty(h)) {
+		expect = cmd.expect[h][1];
+	}
 	if (!type || type === 'auto' || type === 'undefined') {
 		type = detect_format(text);
 	}
 
-	if (expect) {
-		let output = '';
-		if (type === 'ap') {
-			output = diff_stream(expect, text);
-		} else {
-			let diff = null;
-			if (occurrences(expect, '\n') >= 100) {
-				diff = Diff.diffLines(expect, text);
+	if (diff_cache.hasOwnProperty(key)) {
+		$(div).find('pre').html(diff_cache[key]);
+	}
+	else if (expect !== null && type === 'ap') {
+		// Stream diffs are computed and cached by the server
+		post({a: 'diff', c: c, h: h, s: cmd.cmd}).done(function(rv) {
+			if (rv.diff) {
+				diff_cache[key] = render_diff(rv.diff);
 			}
 			else {
-				diff = Diff.diffWordsWithSpace(expect, text);
+				// nothing to compare against any more, e.g. after a rerun
+				diff_cache[key] = hilite_output(esc_html(text), type);
 			}
-			for (let d=0 ; d<diff.length ; ++d) {
-				if (diff[d].added) {
-					output += '<ins>'+esc_html(diff[d].value)+'</ins>';
-				}
-				else if (diff[d].removed) {
-					output += '<del>'+esc_html(diff[d].value)+'</del>';
+			$(div).find('pre').html(diff_cache[key]);
+			div.find('.rt-expanded').hide();
+			div.find('.btnCollapse').hide();
+		});
+	}
+	else if (expect !== null) {
+		let output = '';
+		let diff = null;
+		if (occurrences(expect, '\n') >= 100) {
+			diff = Diff.diffLines(expect, text);
+		}
+		else {
+			diff = Diff.diffWordsWithSpace(expect, text);
+		}
+		for (let d=0 ; d<diff.length ; ++d) {
+			if (diff[d].added) {
+				output += '<ins>'+esc_html(diff[d].value)+'</ins>';
+			}
+			else if (diff[d].removed) {
+				output += '<del>'+esc_html(diff[d].value)+'</del>';
+			}
+			else {
+				let val = esc_html(diff[d].value);
+				if (/\n([^\n]+\n){6}/.test(val)) {
+					let ls = val.split("\n");
+					val = hilite_output(ls[0]+"\n"+ls[1]+"\n"+ls[2]+"\n", type);
+					val += '<div class="rt-expansion"><span class="rt-expanded">'+hilite_output(ls.slice(3, -3).join("\n"), type)+'</span><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnExpand">…</button><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnCollapse">…</button></div>';
+					val += hilite_output(ls[ls.length-3]+"\n"+ls[ls.length-2]+"\n"+ls[ls.length-1], type);
 				}
 				else {
-					let val = esc_html(diff[d].value);
-					if (/\n([^\n]+\n){6}/.test(val)) {
-						let ls = val.split("\n");
-						val = hilite_output(ls[0]+"\n"+ls[1]+"\n"+ls[2]+"\n", type);
-						val += '<div class="rt-expansion"><span class="rt-expanded">'+hilite_output(ls.slice(3, -3).join("\n"), type)+'</span><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnExpand">…</button><button tabindex="-1" type="button" class="btn btn-outline-secondary btn-sm btnCollapse">…</button></div>';
-						val += hilite_output(ls[ls.length-3]+"\n"+ls[ls.length-2]+"\n"+ls[ls.length-1], type);
-					}
-					else {
-						val = hilite_output(val, type);
-					}
-				output += val;
+					val = hilite_output(val, type);
 				}
+			output += val;
 			}
 		}
+		diff_cache[key] = output;
 		$(div).find('pre').html(output);
-		div.removeAttr('data-expect');
-		div.find('.rt-expanded').hide();
-		div.find('.btnExpand').off().click(btn_expand);
-		div.find('.btnCollapse').off().click(btn_collapse).hide();
 	}
 	else {
-		$(div).find('pre').html(hilite_output(esc_html(text), type));
+		diff_cache[key] = hilite_output(esc_html(text), type);
+		$(div).find('pre').html(diff_cache[key]);
 	}
+	div.find('.rt-expanded').hide();
+	div.find('.btnCollapse').hide();
 
 	$(this).attr('data-hilite', true);
 }
@@ -691,23 +683,31 @@ function click_and_show(e) {
 	bootstrap.Tab.getOrCreateInstance(e.get(0)).show();
 }
 
-function btn_select_tab() {
-	let which = $(this).attr('data-which');
+function select_row_tab(tr, which) {
+	let tab = null;
 	if (which === '*FIRST') {
-		$('.rt-changes').find('tr').filter(':visible').each(function() {
-			click_and_show($(this).find('a.rt-changed').first());
-		});
+		tab = tr.find('a.rt-changed').first();
 	}
 	else if (which === '*LAST') {
-		$('.rt-changes').find('tr').filter(':visible').each(function() {
-			click_and_show($(this).find('a.rt-changed').last());
-		});
+		tab = tr.find('a.rt-changed').last();
 	}
 	else {
-		$('.rt-tab-'+which).filter(':visible').each(function() {
-			click_and_show($(this));
-		});
+		tab = tr.find('.rt-tab-'+which);
 	}
+	if (tab.length) {
+		click_and_show(tab);
+	}
+	else {
+		tr.find('.nav-link.active').each(btn_show_tab);
+	}
+}
+
+function btn_select_tab() {
+	let which = $(this).attr('data-which');
+	selected_tab = which;
+	$('.rt-changes').find('tr').not('.rt-pending').filter(':visible').each(function() {
+		select_row_tab($(this), which);
+	});
 
 	if (which === '*FIRST' || which === '*LAST') {
 		$('.btnAcceptAllUntil,.btnCheckedAcceptUntil').addClass('disabled').prop('disabled', true);
@@ -774,6 +774,162 @@ function cb_init(rv) {
 	$('.btnFilterGold').off().click(btn_filter_gold);
 }
 
+function row_meta(c, k) {
+	// Cheap classification of an entry, so that filtering and counting
+	// work before the full row has been rendered
+	let cmds = state[c].cmds;
+	let meta = {
+		changed: false,
+		bucket: 'unchanged',
+		changed_result: '',
+		filter_no_gold: true,
+		filter_unmatched_gold: false,
+		first: state[c].first[k] || null,
+	};
+	for (let i=0 ; i<cmds.length ; ++i) {
+		let cmd = cmds[i];
+		if (!cmd.output.hasOwnProperty(k) || !cmd.expect.hasOwnProperty(k)) {
+			continue;
+		}
+		let has_gold = cmd.gold.hasOwnProperty(k) && cmd.gold[k].length;
+		let in_gold = cmd.matched_gold.hasOwnProperty(k);
+		if (cmd.changed.hasOwnProperty(k)) {
+			if (!meta.changed) {
+				meta.bucket = 'changed_any';
+			}
+			meta.changed = true;
+			if (!in_gold && cmd.relevant) {
+				meta.changed_result = ' rt-changed-result';
+				meta.bucket = 'changed_end';
+			}
+		}
+		if (has_gold) {
+			meta.filter_no_gold = false;
+			if (!in_gold) {
+				meta.filter_unmatched_gold = true;
+			}
+		}
+	}
+	if (!meta.changed) {
+		meta.changed_result = ' rt-unchanged';
+	}
+	return meta;
+}
+
+function render_row(tr) {
+	let c = tr.attr('data-corp');
+	let k = tr.attr('data-hash');
+	let cmds = state[c].cmds;
+	let ins = state[c].inputs;
+
+	let changed = false;
+	let nav = '<ul class="nav nav-tabs" role="tablist">';
+	let body = '<div class="tab-content">';
+	body += '<pre class="rt-input">'+esc_html(ins[k][1])+'</pre>';
+
+	for (let i=0 ; i<cmds.length ; ++i) {
+		let cmd = cmds[i];
+		if (!cmd.output.hasOwnProperty(k)) {
+			continue;
+		}
+		if (!cmd.expect.hasOwnProperty(k)) {
+			continue;
+		}
+
+		let style = '';
+		if (cmd.changed.hasOwnProperty(k)) {
+			if (!changed) {
+				style += ' show active';
+			}
+			style += ' rt-changed';
+			changed = true;
+			if (cmd.matched_gold.hasOwnProperty(k)) {
+				style += ' rt-gold';
+			}
+		}
+		if (i == cmds.length-1) {
+			style += ' rt-last-tab';
+			if (!changed) {
+				style += ' show active';
+			}
+		}
+		if (cmd.gold.hasOwnProperty(k)) {
+			style += ' rt-tab-has-gold';
+		}
+
+		// Highlighting and diffs are filled in by btn_show_tab()
+		let id = c+'-'+k+'-'+cmd.opt;
+		nav += '<li class="nav-item"><a tabindex="-1" class="nav-link rt-tab-'+cmd.opt+style+'" id="'+id+'-tab" data-bs-toggle="tab" href="#'+id+'" role="tab">'+cmd.opt+'</a></li>';
+		body += '<div class="tab-pane'+style+' rt-output p-1" id="'+id+'" role="tabpanel" data-type="'+cmd.type+'" data-cmd="'+i+'"><pre>'+esc_html(cmd.output[k][1])+'</pre>';
+
+		if (cmd.gold.hasOwnProperty(k)) {
+			body += make_gold_list(cmd.gold[k]);
+		}
+		body += '</div>';
+
+		if (cmd.trace.hasOwnProperty(k)) {
+			let id = c+'-'+k+'-'+cmd.opt+'-trace';
+			nav += '<li class="nav-item"><a tabindex="-1" class="nav-link" id="'+id+'-tab" data-bs-toggle="tab" href="#'+id+'" role="tab">-trace</a></li>';
+			body += '<pre class="tab-pane rt-output p-1" id="'+id+'" role="tabpanel" data-type="'+cmd.type+'">'+esc_html(cmd.trace[k][1])+'</pre>';
+		}
+	}
+
+	body += '</div>';
+	nav += '</ul>';
+
+	let btn_types = [
+		// class, label, trailing space
+		["success btnAcceptUntil", "…", ' <span class="rtGold">&nbsp; ',
+		 "accept changes of current and prior steps"],
+		["warning btnGoldReplace", "Replace as Gold", " ",
+		 "remove gold value(s) and replace with current output"],
+		["warning btnGoldAdd", "Add as Gold", " ",
+		 "add current output to list of gold values"],
+		["warning btnGoldManual", "Add Manual Gold ↓", "</span> &nbsp; ",
+		 "manually enter gold value"],
+		["success btnAccept", "Accept Result", " ",
+		 "accept the entire output for this entry"]
+	];
+
+	let html = nav+body+'<div class="text-right my-1">';
+	html += '<select class="form-select form-select-sm selectDiffMode" title="Hide insertions or deletions in diff"><option selected value="ins,del">Diff</option><option value="ins">Inserted</option><option value="del">Deleted</option></select>&nbsp;';
+	html += btn_types.map(function(b) {
+		return '<button tabindex="-1" type="button" class="btn btn-sm btn-outline-'+b[0]+'" title="'+b[3]+'">'+b[1]+'</button>'+b[2];
+	}).join('');
+	html += '<input type="checkbox" class="mx-2 align-middle rt-change-tick"></div><div class="text-right my-1 rt-gold-input"><input type="text" class="rt-gold-input-box"></input> <button tabindex="-1" type="button" class="btn btn-sm btn-outline-warning btnGoldManualAccept">Add as Gold</button> <button tabindex="-1" type="button" class="btn btn-sm btn-outline-primary btnGoldManualCancel">Cancel</button></div>';
+
+	tr.removeClass('rt-pending');
+	tr.children('td').html(html);
+	tr.find('.rt-gold-input').hide();
+	if (selected_tab) {
+		select_row_tab(tr, selected_tab);
+	}
+	else {
+		tr.find('.nav-link.active').each(btn_show_tab);
+	}
+}
+
+function render_visible() {
+	// Rows are in document order, so stop at the first one below the fold
+	let margin = $(window).height();
+	let bottom = $(window).height() + margin;
+	let rows = document.querySelectorAll('#rt-changes tr.rt-pending');
+	for (let i=0 ; i<rows.length ; ++i) {
+		let rect = rows[i].getBoundingClientRect();
+		if (rect.height == 0) {
+			// filtered out
+			continue;
+		}
+		if (rect.top > bottom) {
+			break;
+		}
+		if (rect.bottom < -margin) {
+			continue;
+		}
+		render_row($(rows[i]));
+	}
+}
+
 function cb_load(rv) {
 	$('.rt-added,.rt-deleted,.rt-add-del-warn,.rt-deleted').hide();
 	$('#rt-added,#rt-deleted').find('tbody').remove();
@@ -783,8 +939,10 @@ function cb_load(rv) {
 	let tabs = {};
 	let tabs_html = '';
 	let nd_corps = {};
+	let firsts = {};
 
 	state = rv.state;
+	diff_cache = {};
 
 	let pages = '';
 	if (state._pages > 1) {
@@ -805,13 +963,7 @@ function cb_load(rv) {
 	let del_html = '';
 
 	corpora.forEach(function(c) {
-		state[c].changed_end = '';
-		state[c].changed_any = '';
-		state[c].unchanged = '';
-
-		let cmds = state[c].cmds;
-		let ins = state[c].inputs;
-		let outs = cmds[0].expect;
+		// added and deleted lines are listed for every corpus
 		let add = state[c].add;
 		let del = state[c].del;
 
@@ -825,135 +977,68 @@ function cb_load(rv) {
 			nd_corps[c] = true;
 		}
 
+		if (state[c].summary) {
+			// not on this page
+			return;
+		}
+		state[c].changed_end = '';
+		state[c].changed_any = '';
+		state[c].unchanged = '';
+
+		let cmds = state[c].cmds;
+		let ins = state[c].inputs;
+		let outs = cmds[0].expect;
+
+		for (let i=0 ; i<cmds.length ; ++i) {
+			let n = state[c].steps[cmds[i].opt];
+			if (n) {
+				if (!firsts.hasOwnProperty(cmds[i].opt)) {
+					firsts[cmds[i].opt] = 0;
+				}
+				firsts[cmds[i].opt] += n;
+			}
+			if (!tabs.hasOwnProperty(cmds[i].opt)) {
+				tabs[cmds[i].opt] = true;
+				tabs_html += '<button tabindex="-1" type="button" class="btn btn-sm btn-outline-primary my-1 btnSelectTab" data-which="'+cmds[i].opt+'" title="'+esc_html(cmds[i].cmd)+'">'+cmds[i].opt+'</button>\n';
+			}
+		}
+
 		let ks = [];
 		for (let k in ins) {
 			if (outs.hasOwnProperty(k)) {
 				ks.push(k);
 			}
 		}
+		// When ordering by failure history, keep the server's order
+		let rank = {};
+		for (let i=0 ; i<state._ordered.length ; ++i) {
+			if (state._ordered[i][0] === c) {
+				rank[state._ordered[i][1]] = i;
+			}
+		}
 		ks.sort(function(a, b) {
+			if (rank.hasOwnProperty(a) && rank.hasOwnProperty(b)) {
+				return rank[a] - rank[b];
+			}
 			return ins[a][0] - ins[b][0];
 		});
 
-		let changes = false;
-
+		// Only a placeholder is emitted per entry; render_visible() fills
+		// in the tabs and buttons once the row scrolls into view
 		for (let ki=0 ; ki<ks.length ; ++ki) {
 			let k = ks[ki];
-
-			let changed = false;
-			let changed_result = '';
-			let bucket = 'unchanged';
-			let nav = '<ul class="nav nav-tabs" role="tablist">';
-			let body = '<div class="tab-content">';
-
-			let id = c+'-'+k+'-input';
-			body += '<pre class="rt-input">'+esc_html(ins[k][1])+'</pre>';
-
-			let filter_no_gold = true;
-			let filter_unmatched_gold = false;
-
-			for (let i=0 ; i<cmds.length ; ++i) {
-				let cmd = cmds[i];
-				if (!cmd.output.hasOwnProperty(k)) {
-					continue;
-				}
-				if (!cmd.expect.hasOwnProperty(k)) {
-					continue;
-				}
-
-				let output = esc_html(cmd.output[k][1]);
-				let style = '';
-				let expect = '';
-				if (cmd.output[k][1] !== cmd.expect[k][1]) {
-					if (!changed) {
-						style += ' show active';
-						bucket = 'changed_any';
-					}
-					style += ' rt-changed';
-					changed = true;
-					if (cmd.gold.hasOwnProperty(k) && cmd.gold[k].indexOf(cmd.output[k][1]) != -1) {
-						style += ' rt-gold';
-					} else if (cmd.relevant) {
-						changed_result = ' rt-changed-result';
-						bucket = 'changed_end';
-					}
-
-					expect = ' data-expect="'+esc_html(cmd.expect[k][1])+'"';
-				}
-				if (i == cmds.length-1) {
-					style += ' rt-last-tab';
-					if (!changed) {
-						style += ' show active';
-					}
-				}
-				if (cmd.gold.hasOwnProperty(k)) {
-					style += ' rt-tab-has-gold';
-				}
-
-				if (cmd.gold.hasOwnProperty(k) && cmd.gold[k].length) {
-					filter_no_gold = false;
-					if (cmd.gold[k].indexOf(cmd.output[k][1]) == -1) {
-						filter_unmatched_gold = true;
-					}
-				}
-
-				if (!tabs.hasOwnProperty(cmd.opt)) {
-					tabs[cmd.opt] = true;
-					tabs_html += '<button tabindex="-1" type="button" class="btn btn-sm btn-outline-primary my-1 btnSelectTab" data-which="'+cmd.opt+'" title="'+esc_html(cmd.cmd)+'">'+cmd.opt+'</button>\n';
-				}
-
-				let id = c+'-'+k+'-'+cmd.opt;
-				nav += '<li class="nav-item"><a tabindex="-1" class="nav-link rt-tab-'+cmd.opt+style+'" id="'+id+'-tab" data-bs-toggle="tab" href="#'+id+'" role="tab">'+cmd.opt+'</a></li>';
-				body += '<div class="tab-pane'+style+' rt-output p-1" id="'+id+'" role="tabpanel" data-type="'+cmd.type+'"'+expect+' data-output="'+output+'"><pre>'+output+'</pre>';
-
-				if (cmd.gold.hasOwnProperty(k)) {
-					body += make_gold_list(cmd.gold[k]);
-				}
-				body += '</div>';
-
-				if (cmd.trace.hasOwnProperty(k)) {
-					let id = c+'-'+k+'-'+cmd.opt+'-trace';
-					nav += '<li class="nav-item"><a tabindex="-1" class="nav-link" id="'+id+'-tab" data-bs-toggle="tab" href="#'+id+'" role="tab">-trace</a></li>';
-					body += '<pre class="tab-pane rt-output p-1" id="'+id+'" role="tabpanel" data-type="'+cmd.type+'">'+esc_html(cmd.trace[k][1])+'</pre>';
-				}
-			}
-
-			body += '</div>';
-			nav += '</ul>';
-			if (changed) {
-				changes = true;
-			}
-			else {
-				changed_result = ' rt-unchanged';
-			}
-
-			let btn_types = [
-				// class, label, trailing space
-				["success btnAcceptUntil", "…", ' <span class="rtGold">&nbsp; ',
-				 "accept changes of current and prior steps"],
-				["warning btnGoldReplace", "Replace as Gold", " ",
-				 "remove gold value(s) and replace with current output"],
-				["warning btnGoldAdd", "Add as Gold", " ",
-				 "add current output to list of gold values"],
-				["warning btnGoldManual", "Add Manual Gold ↓", "</span> &nbsp; ",
-				 "manually enter gold value"],
-				["success btnAccept", "Accept Result", " ",
-				 "accept the entire output for this entry"]
-			];
-
+			let meta = row_meta(c, k);
 			let filter_class = 'rt-filter-all';
-			if (filter_no_gold) {
+			if (meta.filter_no_gold) {
 				filter_class += ' rt-filter-no-gold';
 			}
-			if (filter_unmatched_gold) {
+			if (meta.filter_unmatched_gold) {
 				filter_class += ' rt-filter-unmatched-gold';
 			}
-			state[c][bucket] += '<tr data-corp="'+c+'" data-hash="'+k+'" class="'+changed_result+' '+filter_class+' hash-'+k+'"><td>'+nav+body+'<div class="text-right my-1">';
-			state[c][bucket] += '<select class="form-select form-select-sm selectDiffMode" title="Hide insertions or deletions in diff"><option selected value="ins,del">Diff</option><option value="ins">Inserted</option><option value="del">Deleted</option></select>&nbsp;';
-			state[c][bucket] += btn_types.map(function(b) {
-				return '<button tabindex="-1" type="button" class="btn btn-sm btn-outline-'+b[0]+'" title="'+b[3]+'">'+b[1]+'</button>'+b[2];
-			}).join('');
-			state[c][bucket] += '<input type="checkbox" class="mx-2 align-middle rt-change-tick"></div><div class="text-right my-1 rt-gold-input"><input type="text" class="rt-gold-input-box"></input> <button tabindex="-1" type="button" class="btn btn-sm btn-outline-warning btnGoldManualAccept">Add as Gold</button> <button tabindex="-1" type="button" class="btn btn-sm btn-outline-primary btnGoldManualCancel">Cancel</button></div></td></tr>'+"\n";
+			if (meta.first) {
+				filter_class += ' rt-first-'+meta.first;
+			}
+			state[c][meta.bucket] += '<tr data-corp="'+c+'" data-hash="'+k+'" class="rt-pending'+meta.changed_result+' '+filter_class+' hash-'+k+'"><td><pre class="rt-input">'+esc_html(ins[k][1])+'</pre></td></tr>'+"\n";
 		}
 	});
 
@@ -970,6 +1055,13 @@ function cb_load(rv) {
 
 	$('#rt-corpora-tabs').html(tabs_html);
 
+	let firsts_html = '';
+	Object.keys(firsts).forEach(function(f) {
+		firsts_html += ' <button tabindex="-1" type="button" class="btn btn-sm btn-outline-primary my-1 btnFilterFirst" data-which="'+f+'" title="Lines in all pages of these corpora">'+f+' ('+firsts[f]+')</button>';
+	});
+	$('#rt-first-steps').html(firsts_html);
+	$('.btnFilterFirst').off().click(btn_filter_first);
+
 	let nd_btns = '';
 	Object.keys(nd_corps).forEach(function(c) {
 		nd_btns += '<button class="btn btn-outline-success btnAcceptND" data-corp="'+c+'">Accept added/deleted: '+c+'</button> ';
@@ -999,21 +1091,15 @@ function cb_load(rv) {
 	$('.rt-changes').show();
 
 	$('.btnSelectTab').off().click(btn_select_tab);
-	$('.selectDiffMode').off().change(select_diff);
-	$('.btnGoldReplace').off().click(btn_gold_replace);
-	$('.btnGoldAdd').off().click(btn_gold_add);
-	$('.btnGoldManual').off().click(btn_gold_manual);
-	$('.btnGoldManualAccept').off().click(btn_gold_manual_accept);
-	$('.btnGoldManualCancel').off().click(btn_gold_manual_cancel);
-	$('.btnAcceptUntil').off().click(btn_accept_until);
-	$('.btnAccept').off().click(btn_accept);
-	$('.nav-link').off().click(btn_show_tab);
-
-	$('.rt-gold-input').hide();
 
 	if ($('.btnFilter.active').attr('data-which') !== '*') {
 		$('.btnFilter.active').click();
 	}
+	let first_btn = $('.btnFilterFirst').filter(function() { return $(this).attr('data-which') === first_filter; });
+	if (!first_btn.length) {
+		first_btn = $('.btnFilterFirst').first();
+	}
+	first_btn.click();
 
 	let nchange = $('.rt-changed-result:visible').length;
 	let tab = null;
@@ -1058,8 +1144,15 @@ function cb_run(rv) {
 }
 
 function cb_accept(rv) {
+	// Only the affected rows are touched; the rest of the page stays as is
 	for (let i=0 ; i<rv.hs.length ; ++i) {
-		$('.hash-'+rv.hs[i]).fadeOut(500, function() { $(this).remove(); });
+		let h = rv.hs[i];
+		if (state.hasOwnProperty(rv.c) && state[rv.c].cmds) {
+			state[rv.c].cmds.forEach(function(cmd) {
+				delete diff_cache[rv.c+'/'+h+'/'+cmd.opt];
+			});
+		}
+		$('.hash-'+h).fadeOut(500, function() { $(this).remove(); });
 	}
 	$('.rt-add-del-warn').hide();
 	setTimeout(function() {
@@ -1083,7 +1176,8 @@ function cb_accept_nd(rv) {
 }
 
 function event_scroll() {
-	$('.nav-link.active').each(function() {
+	render_visible();
+	$('#rt-changes').find('.nav-link.active').each(function() {
 		if (!$(this).attr('data-hilite') && $(this).isInViewport()) {
 			$(this).click();
 		}
@@ -1100,6 +1194,8 @@ $(function() {
 	$('.btnAcceptAllUntil').hide().off().click(btn_accept_all_until);
 	$('.btnAcceptUnchanged').off().click(btn_accept_unchanged);
 	$('.btnToggleUnchanged').off().click(btn_toggle_unchanged);
+	$('.btnOrderHistory').off().click(btn_order_history);
+	$('.btnAcceptFirst').hide().off().click(btn_accept_first);
 
 	$('.btnCheckedGoldReplace').off().click(btn_checked_gold_replace);
 	$('.btnCheckedGoldAdd').off().click(btn_checked_gold_add);
@@ -1111,5 +1207,19 @@ $(function() {
 		$('.selectDiffMode').val(this.value).change();
 	});
 
+	// Rows are rendered lazily, so their controls use delegated handlers
+	$('#rt-changes').
+		on('change', '.selectDiffMode', select_diff).
+		on('click', '.btnGoldReplace', btn_gold_replace).
+		on('click', '.btnGoldAdd', btn_gold_add).
+		on('click', '.btnGoldManual', btn_gold_manual).
+		on('click', '.btnGoldManualAccept', btn_gold_manual_accept).
+		on('click', '.btnGoldManualCancel', btn_gold_manual_cancel).
+		on('click', '.btnAcceptUntil', btn_accept_until).
+		on('click', '.btnAccept', btn_accept).
+		on('click', '.btnExpand', btn_expand).
+		on('click', '.btnCollapse', btn_collapse).
+		on('click', '.nav-link', btn_show_tab);
+
 	$(window).on('resize scroll', event_scroll);
 });
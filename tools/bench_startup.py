@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser('measure how long `apertium-regtest test` takes to start and to finish when nothing has changed')
+parser.add_argument('-n', '--runs', type=int, default=10, help='number of times to run each command (default: 10)')
+parser.add_argument('-i', '--imports', type=int, default=0, metavar='N', help='also list the N slowest modules imported when nothing has changed')
+parser.add_argument('-m', '--max', type=float, metavar='MS', help='exit with an error if the median time when nothing has changed is more than this many milliseconds')
+args = parser.parse_args()
+
+if not os.path.isfile('test/tests.json'):
+    print('test/tests.json not found.')
+    print('Please run this script from the top level of an Apertium directory.')
+    sys.exit(1)
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apertium-regtest.py')
+
+def timed(cmd, runs):
+    # wall time of each run in milliseconds
+    ret = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ret.append((time.perf_counter() - start) * 1000)
+    return ret
+
+def report(name, times):
+    print('%-34s min %7.1f ms  median %7.1f ms' % (name, min(times), statistics.median(times)))
+
+# the first run records test/.regtest/manifest.json if it isn't up to date
+print('Warming up...')
+subprocess.run([sys.executable, script, 'test'], stdout=subprocess.DEVNULL)
+
+report('python interpreter', timed([sys.executable, '-c', 'pass'], args.runs))
+
+# a script run directly is compiled every time, since only imported
+# modules get their bytecode cached
+with open(script) as fin:
+    src = fin.read()
+times = []
+for i in range(args.runs):
+    start = time.perf_counter()
+    compile(src, script, 'exec')
+    times.append((time.perf_counter() - start) * 1000)
+report('compiling apertium-regtest', times)
+
+report('apertium-regtest --help', timed([sys.executable, script, '--help'], args.runs))
+unchanged = timed([sys.executable, script, 'test'], args.runs)
+report('apertium-regtest test (no changes)', unchanged)
+
+if args.imports > 0:
+    proc = subprocess.run([sys.executable, '-X', 'importtime', script, 'test'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    mods = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # only top-level imports, not the modules they import in turn
+        if parts[2].startswith('  '):
+            continue
+        mods.append((int(parts[1]), parts[2].strip()))
+    print('')
+    print('Slowest imports when nothing has changed:')
+    for us, name in sorted(mods, reverse=True)[:args.imports]:
+        print('  %-28s %7.1f ms' % (name, us / 1000))
+
+if args.max is not None and statistics.median(unchanged) > args.max:
+    print('')
+    print('Median time with no changes is more than %s ms.' % args.max)
+    sys.exit(1)
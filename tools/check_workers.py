@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser('check that `apertium-regtest test --workers` gives the same outputs and report as running the tests locally, using workers started on this machine')
+parser.add_argument('-n', '--workers', type=int, default=2, help='number of workers to start (default: 2)')
+parser.add_argument('-p', '--port', type=int, default=3100, help='port of the first worker, the others use the ports after it (default: 3100)')
+parser.add_argument('--shard-size', type=int, default=0, help='split corpora into shards of this many lines (default: whole corpora)')
+args = parser.parse_args()
+
+if not os.path.isfile('test/tests.json'):
+    print('test/tests.json not found.')
+    print('Please run this script from the top level of an Apertium directory.')
+    sys.exit(1)
+
+# outputs are read by apertium-regtest itself, since sharded runs
+# write the lines of each step in a different order
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apertium-regtest.py')
+spec = importlib.util.spec_from_file_location('regtest', script)
+regtest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(regtest)
+Corpus = regtest.Corpus
+
+regtest.load_modes()
+regtest.load_corpora([], static=True)
+
+def run_test(extra):
+    # exit status and report of `apertium-regtest test`
+    proc = subprocess.run([sys.executable, script, 'test', '--force'] + extra,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+    # progress of the workers isn't part of the report
+    lines = [l for l in proc.stdout.splitlines()
+             if not (l.startswith('Finished ') and ' shard ' in l)]
+    return proc.returncode, lines
+
+def outputs():
+    # { output file : { hash : digest } } for every step of every corpus
+    ret = {}
+    for name in sorted(Corpus.all_corpora):
+        corpus = Corpus.all_corpora[name]
+        for c in corpus.command_list:
+            fname = corpus.out_name(c)
+            out = regtest.load_output(fname)
+            ret[fname] = {h: out.digest(h) for h in out}
+    return ret
+
+def wait_for(proc, port):
+    # the worker is up once it accepts connections
+    for i in range(100):
+        if proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+print('Running the tests locally...')
+local_status, local_report = run_test([])
+local_outputs = outputs()
+
+addrs = ['localhost:%d' % (args.port + i) for i in range(args.workers)]
+procs = []
+failed = []
+try:
+    for addr in addrs:
+        procs.append(subprocess.Popen([sys.executable, script, 'worker', '-p', addr.split(':')[1]],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for proc, addr in zip(procs, addrs):
+        if not wait_for(proc, int(addr.split(':')[1])):
+            print('Worker %s did not start. Is the port in use?' % addr)
+            sys.exit(1)
+
+    print('Running the tests on %s workers...' % len(addrs))
+    extra = ['--workers', ','.join(addrs), '--shard-size', str(args.shard_size)]
+    status, report = run_test(extra)
+    if status != local_status:
+        failed.append('exit status %s, but %s when run locally' % (status, local_status))
+    if report != local_report:
+        failed.append('the report differs from the one when run locally')
+        for l in report:
+            if l not in local_report:
+                print('  + ' + l)
+        for l in local_report:
+            if l not in report:
+                print('  - ' + l)
+    for fname, out in outputs().items():
+        if out != local_outputs.get(fname):
+            failed.append('%s differs from the output when run locally' % fname)
+
+    # a worker must refuse jobs for an input it doesn't have
+    name = sorted(Corpus.all_corpora)[0]
+    resp = regtest.request_run(addrs[0], name, 'not-the-input', None)
+    if 'differs' not in resp.get('error', ''):
+        failed.append('worker ran %s with the wrong input digest' % name)
+finally:
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+if failed:
+    for f in failed:
+        print('FAILED: ' + f)
+    sys.exit(1)
+print('Outputs and report match with %s workers.' % len(addrs))
@@ -1,69 +1,146 @@
 #!/usr/bin/env python3
 
 import argparse
-import base64
-import hashlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
 import json
 import os
+import sys
 import yaml
 
-def hash_line(s):
-    return base64.b64encode(hashlib.sha256(s.encode('utf-8')).digest(), b'-_')[:12].decode('utf-8')
+# lines are hashed by apertium-regtest itself, so that the golds are
+# keyed by the hashes load_input() will find
+spec = importlib.util.spec_from_file_location('regtest',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apertium-regtest.py'))
+regtest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(regtest)
 
-parser = argparse.ArgumentParser('convert morph-test yaml files to apertium-regtest directories')
-parser.add_argument('lang', help='ISO code of language')
-parser.add_argument('yaml', help='file to convert')
-parser.add_argument('-d', '--dir', help='location of test directory (default: cwd)', default='.')
-args = parser.parse_args()
+def input_hash(line):
+    # the hash of line as it will be read back from an input file, or
+    # None if it won't be read back as exactly one line
+    hashes = regtest.parse_input(line)[1]
+    if len(hashes) != 1:
+        return None
+    return hashes[0]
 
-new_tests = {}
+def find_yaml(paths):
+    # the given files, and the .yaml files in the given directories
+    for pth in paths:
+        if not os.path.isdir(pth):
+            yield pth
+            continue
+        for root, dirs, files in os.walk(pth):
+            dirs.sort()
+            for fname in sorted(files):
+                if fname.endswith(('.yaml', '.yml')):
+                    yield os.path.join(root, fname)
 
-def do_test(name, tst):
-    analysis = []
-    surf = []
-    for k_, v_ in tst.items():
-        k = '^' + k_ + '$'
-        v = v_ if isinstance(v_, str) else v_[0]
-        surf.append((v, hash_line(k)))
-        analysis.append((k, hash_line(v)))
-    if len(surf) == 0:
-        return
-    with open('%s-input.txt' % name, 'w') as fout:
-        surf.sort()
-        for s, h in surf:
-            fout.write(s + '\n')
-    with open('%s-gen-generator-gold.txt' % name, 'w') as fout:
-        surf.sort(key=lambda x: x[1])
-        for s, h in surf:
-            fout.write('[%s]\n%s [/option]\n[/%s]\n' % (h, s, h))
-    with open('%s-gen-input.txt' % name, 'w') as fout:
-        analysis.sort()
-        for a, h in analysis:
-            fout.write(a + '\n')
-    with open('%s-morph-gold.txt' % name, 'w') as fout:
-        analysis.sort(key=lambda x: x[1])
-        for a, h in analysis:
-            fout.write('[%s]\n%s [/option]\n[/%s]\n' % (h, a, h))
-    global new_tests, args
-    new_tests[name] = {
-        'input': '%s-input.txt' % name,
-        'mode': '%s-morph' % args.lang
-    }
-    new_tests[name + '-gen'] = {
-        'input': '%s-gen-input.txt' % name,
-        'mode': '%s-gener' % args.lang
+def read_yaml(fname):
+    # [(test name, [(analysis, surface form)])], usually in a worker process
+    with open(fname) as fin:
+        blob = yaml.load(fin.read(), yaml.BaseLoader)
+    ret = []
+    for name, tst in blob['Tests'].items():
+        pairs = []
+        for k_, v_ in tst.items():
+            pairs.append(('^' + k_ + '$', v_ if isinstance(v_, str) else v_[0]))
+        ret.append((name.replace(' ', '_').replace('/', '_'), pairs))
+    return ret
+
+def gold_text(gold):
+    txt = ''
+    for h in sorted(gold):
+        txt += '[%s]\n' % h
+        txt += ''.join('%s [/option]\n' % o for o in sorted(gold[h]))
+        txt += '[/%s]\n' % h
+    return txt
+
+def test_files(name, pairs):
+    # { file name : contents } for the corpora of one test
+    surf = set()
+    analysis = set()
+    gen_gold = defaultdict(set)
+    morph_gold = defaultdict(set)
+    for k, v in pairs:
+        hk = input_hash(k)
+        if hk:
+            analysis.add(k)
+            gen_gold[hk].add(v)
+        hv = input_hash(v)
+        if hv:
+            surf.add(v)
+            morph_gold[hv].add(k)
+    return {
+        '%s-input.txt' % name: ''.join(s + '\n' for s in sorted(surf)),
+        '%s-gen-generator-gold.txt' % name: gold_text(gen_gold),
+        '%s-gen-input.txt' % name: ''.join(a + '\n' for a in sorted(analysis)),
+        '%s-morph-gold.txt' % name: gold_text(morph_gold)
     }
 
-with open(args.yaml) as fin:
+def write_if_changed(fname, txt):
+    # returns whether fname was written
+    if os.path.isfile(fname):
+        with open(fname) as fin:
+            if fin.read() == txt:
+                return False
+    tmp = '%s.tmp-%s' % (fname, os.getpid())
+    with open(tmp, 'w') as fout:
+        fout.write(txt)
+    os.replace(tmp, fname)
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('convert morph-test yaml files to apertium-regtest directories')
+    parser.add_argument('lang', help='ISO code of language')
+    parser.add_argument('yaml', nargs='+', help='files to convert, or directories containing them')
+    parser.add_argument('-d', '--dir', help='location of test directory (default: cwd)', default='.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of files to convert at once (default: number of CPUs)')
+    args = parser.parse_args()
+
+    files = list(find_yaml(args.yaml))
+    if not files:
+        print('No yaml files found.')
+        sys.exit(1)
+
+    # a test which appears in several files gets all of their lines
+    tests = defaultdict(list)
+    with ProcessPoolExecutor(max(1, args.jobs)) as pool:
+        for res in pool.map(read_yaml, files):
+            for name, pairs in res:
+                tests[name] += pairs
+
     pth = os.path.join(args.dir, 'test')
     if not os.path.isdir(pth):
         os.mkdir(pth)
     os.chdir(pth)
-    blob = yaml.load(fin.read(), yaml.BaseLoader)
-    for name, tst in blob['Tests'].items():
-        do_test(name.replace(' ', '_').replace('/', '_'), tst)
-if os.path.isfile('tests.json'):
-    with open('tests.json') as fin:
-        new_tests.update(json.loads(fin.read()))
-with open('tests.json', 'w') as js:
-    js.write(json.dumps(new_tests))
+
+    new_tests = {}
+    written = 0
+    unchanged = 0
+    for name, pairs in sorted(tests.items()):
+        if not pairs:
+            continue
+        for fname, txt in test_files(name, pairs).items():
+            if write_if_changed(fname, txt):
+                written += 1
+            else:
+                unchanged += 1
+        new_tests[name] = {
+            'input': '%s-input.txt' % name,
+            'mode': '%s-morph' % args.lang
+        }
+        new_tests[name + '-gen'] = {
+            'input': '%s-gen-input.txt' % name,
+            'mode': '%s-gener' % args.lang
+        }
+    print('Converted %s files: %s test files written, %s unchanged' % (len(files), written, unchanged))
+
+    old_tests = {}
+    if os.path.isfile('tests.json'):
+        with open('tests.json') as fin:
+            old_tests = json.loads(fin.read())
+    new_tests.update(old_tests)
+    if new_tests != old_tests:
+        write_if_changed('tests.json', json.dumps(new_tests))
+        print('Added %s corpora to tests.json' % (len(new_tests) - len(old_tests)))
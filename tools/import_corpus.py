@@ -1,51 +1,111 @@
 #!/usr/bin/env python3
 
 import argparse
-import base64
-import hashlib
+import importlib.util
+import itertools
+import multiprocessing
 import os
-from collections import defaultdict
-
-def hash_line(s):
-    return base64.b64encode(hashlib.sha256(s.encode('utf-8')).digest(), b'-_')[:12].decode('utf-8')
-
-parser = argparse.ArgumentParser('convert a text corpus to apertium-regtest inputs and golds')
-parser.add_argument('test', help='test corpus to create or append to')
-parser.add_argument('corp', help='input corpus to convert')
-parser.add_argument('-d', '--dir', help='location of test directory (default: current directory)', default='.')
-parser.add_argument('-s', '--sep', help='separator between input and gold (default: newline)', default='\n')
-args = parser.parse_args()
-
-inp = []
-gold = defaultdict(list)
-
-with open(args.corp) as fin:
-    line_sep = '\n\n' if args.sep == '\n' else '\n'
-    txt = fin.read().split(line_sep)
-    for line in txt:
-        ls = line.strip().split(args.sep)
-        if len(ls) < 2:
-            continue
-        i = ls[0]
-        g = ls[1]
-        inp.append(i)
-        gold[hash_line(i)].append(g)
-
-pth = os.path.join(args.dir, 'test')
-if not os.path.isdir(pth):
-    os.mkdir(pth)
-os.chdir(pth)
-
-with open(args.test + '-input.txt', 'a') as fout:
-    fout.write('\n' + '\n'.join(inp))
-    print('Inputs written to', os.path.join(pth, args.test + '-input.txt'))
-
-with open(args.test + '-generator-gold.txt', 'a') as fout:
-    fout.write('\n')
-    for k in sorted(gold.keys()):
-        fout.write('[%s]\n' % k)
-        fout.write(''.join(g + ' [/option]\n' for g in gold[k]))
-        fout.write('[/%s]\n' % k)
-    print('Gold values written to', os.path.join(pth, args.test + '-generator-gold.txt'))
-
-print('If either of these is the wrong file, the contents can be safely copied to the end of the correct file(s).')
+
+# lines are hashed and golds read and written by apertium-regtest itself,
+# so that the hashes are the ones load_input() will find
+spec = importlib.util.spec_from_file_location('regtest',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apertium-regtest.py'))
+regtest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(regtest)
+
+def read_pairs(fname, sep):
+    # (input, gold) for each entry of the corpus, one line at a time
+    with open(fname) as fin:
+        if sep != '\n':
+            for line in fin:
+                ls = line.strip().split(sep)
+                if len(ls) >= 2:
+                    yield ls[0], ls[1]
+            return
+        # entries are separated by blank lines
+        ls = []
+        for line in itertools.chain(fin, ['\n']):
+            line = line.strip()
+            if line:
+                ls.append(line)
+                continue
+            if len(ls) >= 2:
+                yield ls[0], ls[1]
+            ls = []
+
+def hash_pair(pair):
+    # the hash of the input as it will be read back, or None if
+    # it won't be read back as exactly one line
+    hashes = regtest.parse_input(pair[0])[1]
+    if len(hashes) != 1:
+        return None, pair
+    return hashes[0], pair
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('convert a text corpus to apertium-regtest inputs and golds')
+    parser.add_argument('test', help='test corpus to create or append to')
+    parser.add_argument('corp', help='input corpus to convert')
+    parser.add_argument('-d', '--dir', help='location of test directory (default: current directory)', default='.')
+    parser.add_argument('-s', '--sep', help='separator between input and gold (default: newline)', default='\n')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to hash lines with (default: 1)')
+    args = parser.parse_args()
+
+    corp = os.path.abspath(args.corp)
+    os.chdir(args.dir)
+    if not os.path.isdir('test'):
+        os.mkdir('test')
+    infile = os.path.join('test', args.test + '-input.txt')
+    goldfile = os.path.join('test', args.test + '-generator-gold.txt')
+
+    known = set()
+    newline = True
+    if os.path.isfile(infile):
+        try:
+            known.update(regtest.load_input(infile).keys())
+        except regtest.InputFileIsEmpty:
+            pass
+        with open(infile, 'rb') as fin:
+            if fin.seek(0, os.SEEK_END) > 0:
+                fin.seek(-1, os.SEEK_END)
+                newline = (fin.read(1) == b'\n')
+    gold = regtest.load_gold(goldfile)
+    old_options = sum(len(opts) for opts in gold.values())
+
+    pairs = read_pairs(corp, args.sep)
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        hashed = pool.imap(hash_pair, pairs, chunksize=4096)
+    else:
+        hashed = map(hash_pair, pairs)
+
+    added = 0
+    present = 0
+    skipped = 0
+    with open(infile, 'a') as fout:
+        if not newline:
+            fout.write('\n')
+        for hsh, (i, g) in hashed:
+            if hsh is None:
+                skipped += 1
+                continue
+            if hsh in known:
+                present += 1
+            else:
+                known.add(hsh)
+                fout.write(i + '\n')
+                added += 1
+            opts = gold.setdefault(hsh, [])
+            if g not in opts:
+                opts.append(g)
+    if pool:
+        pool.close()
+        pool.join()
+    print('Inputs written to', os.path.join(args.dir, infile))
+    print('  %s added, %s already present, %s skipped' % (added, present, skipped))
+
+    regtest.save_gold(goldfile, gold)
+    print('Gold values written to', os.path.join(args.dir, goldfile))
+    print('  %s options added' % (sum(len(opts) for opts in gold.values()) - old_options))
+
+    print('If either of these is the wrong file, the contents can be safely copied to the end of the correct file(s).')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser('convert the expected and gold files of an apertium-regtest directory to one packed file per corpus, or back')
+parser.add_argument('-u', '--unpack', action='store_true', help='convert packed files back to one file per step')
+parser.add_argument('-d', '--delta', action='store_true', help='delta-encode each step against the previous one')
+args = parser.parse_args()
+
+if not os.path.isdir('test'):
+    print('test/ not found.')
+    print('Please run this script from the top level of an Apertium directory.')
+    sys.exit(1)
+
+# reading and writing is left to apertium-regtest itself
+spec = importlib.util.spec_from_file_location('regtest',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apertium-regtest.py'))
+regtest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(regtest)
+Corpus = regtest.Corpus
+
+regtest.load_modes()
+regtest.load_corpora([], static=True)
+packed = Corpus.packed
+if packed != args.unpack:
+    print('The tests are already %s.' % ('unpacked' if args.unpack else 'packed'))
+    sys.exit(1)
+regtest.Pack.delta = args.delta
+
+def names(corp, c, packed):
+    Corpus.packed = packed
+    return corp.exp_name(c), corp.gold_name(c)
+
+old = set()
+new = set()
+for name, corp in sorted(Corpus.all_corpora.items()):
+    expected = {}
+    gold = {}
+    for c in corp.command_list:
+        exp, gld = names(corp, c, packed)
+        new_exp, new_gld = names(corp, c, not packed)
+        if regtest.output_exists(exp):
+            expected[new_exp] = regtest.load_output(exp)
+            old.add(regtest.split_member(exp)[0] or exp)
+            new.add(regtest.split_member(new_exp)[0] or new_exp)
+        if regtest.output_exists(gld):
+            gold[new_gld] = regtest.load_gold(gld)
+            old.add(regtest.split_member(gld)[0] or gld)
+            new.add(regtest.split_member(new_gld)[0] or new_gld)
+    Corpus.packed = not packed
+    if Corpus.packed:
+        regtest.save_packed(dict(expected, **gold))
+    else:
+        if not Corpus.flat:
+            regtest.ensure_dir_exists('expected')
+            regtest.ensure_dir_exists('gold')
+        for fname, data in expected.items():
+            regtest.save_output(fname, data)
+        for fname, data in gold.items():
+            regtest.save_gold(fname, data)
+    print('%s: %s expected and %s gold files' % (name, len(expected), len(gold)))
+
+for fname in old:
+    os.remove(fname)
+
+with open('test/tests.json') as fin:
+    tests = json.loads(fin.read())
+settings = tests.setdefault('settings', {})
+if args.unpack:
+    settings.pop('storage', None)
+    settings.pop('delta', None)
+    if not settings:
+        del tests['settings']
+else:
+    settings['storage'] = 'packed'
+    if args.delta:
+        settings['delta'] = True
+with open('test/tests.json', 'w') as js:
+    js.write(json.dumps(tests, indent=4) + '\n')
+
+subprocess.run(['git', 'rm', '-q', '--cached', '--ignore-unmatch'] + sorted(old))
+subprocess.run(['git', 'add', 'test/tests.json'] + sorted(new))